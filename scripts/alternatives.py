@@ -0,0 +1,241 @@
+from dataclasses import dataclass, field
+from typing import Any
+from scripts.solver import *
+
+import argparse
+import heapq
+import multiprocessing
+
+"""
+Finds the K cheapest recipes which use different sets of products, rather than
+just the single cheapest one, so there's something else to choose from when
+the best recipe isn't liked.
+
+Each recipe after the first excludes the product sets of those before it. A
+no-good cut like that would need a binary per product, which HiGHS's
+semi-continuous columns don't have, so the cuts are made by partitioning
+instead (Lawler's method): if the best recipe uses s_1, ..., s_m, then every
+other product set either leaves out s_1, or uses s_1 and leaves out s_2, and
+so on. Each of those branches is the same model with a few bounds changed, so
+the model is built once and shared by a pool of workers. It isn't presolved:
+dominance presolve drops products which are no better than another, and so
+would hide alternatives that differ only by those.
+
+Branches are only solved when they might hold the next recipe: each is first
+queued by its LP relaxation, which is a lower bound on its cost and takes a
+fraction of the time of the MILP, and the most promising ones are solved in
+parallel. Each solve is seeded with the cheapest recipe already found which
+fits the branch, and cut off at the cost of the K-th best recipe known so far.
+
+Run with: python3 -m scripts.alternatives 5
+"""
+
+# one part of the partition: the columns a recipe must use, and those it can't.
+# until it's solved, x is None and cost is only a lower bound
+@dataclass(order=True)
+class Branch:
+    cost: float
+    unsolved: bool
+    x: np.ndarray | None = field(compare=False)
+    forced: frozenset[int] = field(compare=False)
+    forbidden: frozenset[int] = field(compare=False)
+
+    # the branches covering every other product set under this one, i.e.
+    # those which don't use all of this branch's recipe
+    def children(self) -> list[tuple[frozenset[int], frozenset[int]]]:
+        assert self.x is not None
+        used = [ int(i) for i in np.flatnonzero(self.x > 0) if i not in self.forced ]
+        out = []
+
+        for k, col in enumerate(used):
+            out.append((self.forced | set(used[:k]), self.forbidden | {col}))
+
+        return out
+
+    def fits(self, forced: frozenset[int], forbidden: frozenset[int]) -> bool:
+        return self.x is not None\
+            and all(self.x[i] > 0 for i in forced)\
+            and all(self.x[i] == 0 for i in forbidden)
+
+# set up in each worker by attach_worker: the model, and its LP relaxation
+worker: dict[str, Any] = {}
+
+def attach_worker(model: Model, options: dict[str, Any]):
+    lp = model.highs_lp()
+
+    for name, integrality in [("highs", lp.integrality_), ("relaxed", [])]:
+        highs = highspy.Highs()
+        highs.setOptionValue("output_flag", False)
+        highs.setOptionValue("threads", 1)
+        for k, v in options.items():
+            highs.setOptionValue(k, v)
+
+        lp.integrality_ = integrality
+        lp.col_lower_ = model.lower if name == "highs" else np.zeros(len(model.cols))
+        highs.passModel(lp)
+        worker[name] = highs
+
+    worker["model"] = model
+
+# the lower bound on a branch given by its LP relaxation, where any column can
+# be anywhere from 0 to its upper bound except the forced ones, which have to
+# be at least their lower bound. None if even that's infeasible
+def relax_branch(task: tuple[list[int], list[int]]) -> float | None:
+    forced, forbidden = task
+    highs: highspy.Highs = worker["relaxed"]
+    model: Model = worker["model"]
+
+    forced_cols = np.array(forced, dtype=np.int32)
+    forbidden_cols = np.array(forbidden, dtype=np.int32)
+    cols = np.concatenate((forced_cols, forbidden_cols))
+
+    highs.changeColsBounds(len(forced_cols), forced_cols, model.lower[forced_cols], model.upper[forced_cols])
+    highs.changeColsBounds(len(forbidden_cols), forbidden_cols, np.zeros(len(forbidden_cols)), np.zeros(len(forbidden_cols)))
+
+    try:
+        highs.run()
+        if highs.getModelStatus() != highspy.HighsModelStatus.kOptimal:
+            return None
+
+        return highs.getInfo().objective_function_value
+    finally:
+        highs.changeColsBounds(len(cols), cols, np.zeros(len(cols)), model.upper[cols])
+
+# solves one branch in a worker: forbidden columns are fixed at 0, and forced
+# ones are made continuous between their lower and upper bounds. the model is
+# put back as it was afterwards
+def solve_branch(task: tuple[list[int], list[int], np.ndarray | None, float]) -> tuple[np.ndarray, bool] | None:
+    forced, forbidden, seed, bound = task
+    highs: highspy.Highs = worker["highs"]
+    model: Model = worker["model"]
+
+    forced_cols = np.array(forced, dtype=np.int32)
+    forbidden_cols = np.array(forbidden, dtype=np.int32)
+    cols = np.concatenate((forced_cols, forbidden_cols))
+
+    zeros = np.zeros(len(forbidden_cols))
+    highs.changeColsBounds(len(forbidden_cols), forbidden_cols, zeros, zeros)
+    highs.changeColsIntegrality(
+        len(forced_cols), forced_cols,
+        np.array([ highspy.HighsVarType.kContinuous ] * len(forced_cols)),
+    )
+    highs.setOptionValue("objective_bound", bound)
+
+    if seed is not None:
+        solution = highspy.HighsSolution()
+        solution.col_value = seed
+        solution.value_valid = True
+        highs.setSolution(solution)
+
+    try:
+        highs.run()
+        status = highs.getModelStatus()
+
+        if not highs.getSolution().value_valid or status == highspy.HighsModelStatus.kInfeasible:
+            return None
+
+        return np.array(highs.getSolution().col_value), status == highspy.HighsModelStatus.kOptimal
+    finally:
+        highs.changeColsBounds(len(cols), cols, model.lower[cols], model.upper[cols])
+        highs.changeColsIntegrality(
+            len(cols), cols,
+            np.array([ highspy.HighsVarType.kSemiContinuous ] * len(cols)),
+        )
+        highs.clearSolver()
+
+# the k cheapest recipes using different sets of products, in order of price.
+# no recipe uses every product of one before it. each branch is solved for at
+# most time_limit seconds, if given
+def alternatives(
+    problem: Problem,
+    k: int,
+    processes: int | None = None,
+    time_limit: float | None = None,
+) -> list[Solution]:
+    if not problem.allowed.any():
+        return []
+
+    # without dominance presolve, which drops products that tie on price with
+    # others, and with them any alternative differing only by those products
+    model = problem.model(presolve=False)
+    options = {} if time_limit is None else { "time_limit": time_limit }
+
+    result = solve_highs(model, **options)
+    if result is None:
+        return []
+
+    processes = processes or os.cpu_count() or 1
+    queue = [ Branch(float(model.prices @ result[0]), False, result[0], frozenset(), frozenset()) ]
+    found = list(queue)
+    chosen: list[Branch] = []
+
+    with multiprocessing.Pool(processes, initializer=attach_worker, initargs=(model, options)) as pool:
+        while len(queue) > 0 and len(chosen) < k:
+            # a solved branch at the front is cheaper than anything the rest
+            # could hold, so it's the next recipe
+            if not queue[0].unsolved:
+                branch = heapq.heappop(queue)
+                chosen.append(branch)
+                if len(chosen) == k:
+                    break
+
+                children = branch.children()
+                bounds = pool.map(relax_branch, [ (sorted(f), sorted(b)) for f, b in children ])
+
+                for (forced, forbidden), bound in zip(children, bounds):
+                    if bound is not None:
+                        heapq.heappush(queue, Branch(bound, True, None, forced, forbidden))
+
+                continue
+
+            # otherwise, solve the most promising branches, up to one per worker
+            batch = []
+            while len(queue) > 0 and queue[0].unsolved and len(batch) < processes:
+                batch.append(heapq.heappop(queue))
+
+            # anything dearer than the cheapest (k - chosen) known recipes can
+            # never be picked
+            needed = k - len(chosen)
+            known = sorted(b.cost for b in queue if not b.unsolved)
+            cutoff = known[needed - 1] if len(known) >= needed else np.inf
+
+            tasks = []
+            for branch in batch:
+                seeds = [ b for b in found if b.cost <= cutoff and b.fits(branch.forced, branch.forbidden) ]
+                seed = min(seeds).x if len(seeds) > 0 else None
+                tasks.append((sorted(branch.forced), sorted(branch.forbidden), seed, cutoff))
+
+            for branch, result in zip(batch, pool.map(solve_branch, tasks)):
+                if result is None:
+                    continue
+
+                solved = Branch(float(model.prices @ result[0]), False, result[0], branch.forced, branch.forbidden)
+                found.append(solved)
+                heapq.heappush(queue, solved)
+
+    return [ problem.make_model_recipe(model, b.x) for b in chosen ]
+
+def main():
+    parser = argparse.ArgumentParser(description="find the k cheapest recipes with different products")
+    parser.add_argument("k", type=int, nargs="?", default=5)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--time-limit", type=float, default=None, help="seconds per branch")
+    args = parser.parse_args()
+
+    problem = Problem.load(dict(target), get_engine())
+
+    problem.taxonomy_blacklist = list(taxonomy_blacklist)
+    problem.taxonomy_whitelist = list(taxonomy_whitelist)
+    problem.reapply_filter()
+    print(f"{len(problem.products)} products found")
+
+    start = time.perf_counter()
+    solutions = alternatives(problem, args.k, args.processes, args.time_limit)
+    print(f"found {len(solutions)} recipes in {time.perf_counter() - start:.2f}s")
+
+    for i, solution in enumerate(solutions):
+        print(f"\n=== recipe {i + 1} ===")
+        solution.print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+from typing import Any, Iterable, Iterator
+from scripts.solver import *
+from src.matrix import NutrientMatrix
+from src.presolve import dominated_columns
+
+import argparse
+import json
+import multiprocessing
+import numpy as np
+import sys
+import time
+
+"""
+Solves many targets (e.g. one per person in a population study) against the
+same catalogue. The products are loaded and the nutrient matrix is built once,
+then shared with a pool of worker processes, each of which solves targets
+independently.
+
+The targets file is JSONL, with a line per target:
+
+    {"id": "person-1", "target": {"energy": [2000, 2200], "protein": [60, null]}}
+
+Results are written as they arrive, to JSONL or (with pyarrow) Parquet.
+
+Run with: python3 -m scripts.batch targets.jsonl results.jsonl
+"""
+
+# a numpy array in shared memory, which workers attach to by name
+@dataclass
+class SharedArray:
+    name: str
+    shape: tuple[int, ...]
+    dtype: str
+
+    @classmethod
+    def create(cls, arr: np.ndarray) -> tuple["SharedArray", shared_memory.SharedMemory]:
+        shm = shared_memory.SharedMemory(create=True, size=max(1, arr.nbytes))
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+        return cls(shm.name, arr.shape, arr.dtype.str), shm
+
+    def attach(self) -> tuple[np.ndarray, shared_memory.SharedMemory]:
+        shm = shared_memory.SharedMemory(name=self.name)
+        return np.ndarray(self.shape, dtype=np.dtype(self.dtype), buffer=shm.buf), shm
+
+# what each worker needs from the problem: the nutrient matrix, prices and the
+# (filtered) semi-continuous bounds of every product
+@dataclass
+class SharedCatalogue:
+    arrays: dict[str, SharedArray]
+    presolve: bool
+
+# set up in each worker by attach_worker
+worker: dict[str, Any] = {}
+
+def share_problem(problem: Problem, presolve: bool) -> tuple[SharedCatalogue, list[shared_memory.SharedMemory]]:
+    lower, upper = problem.column_bounds()
+    matrix = problem.matrix
+
+    arrays = {
+        "values": matrix.values,
+        "unit_amounts": matrix.unit_amounts,
+        "prices": problem.all_prices,
+        "lower": lower,
+        "upper": upper,
+        "taxa": matrix.taxa,
+        "taxon_bits": matrix.taxon_bits,
+    }
+
+    specs, handles = {}, []
+    for name, arr in arrays.items():
+        specs[name], shm = SharedArray.create(np.ascontiguousarray(arr))
+        handles.append(shm)
+
+    return SharedCatalogue(specs, presolve), handles
+
+def attach_worker(catalogue: SharedCatalogue):
+    arrays = {}
+    for name, spec in catalogue.arrays.items():
+        arrays[name], shm = spec.attach()
+        worker.setdefault("handles", []).append(shm)
+
+    values = arrays["values"]
+    worker["matrix"] = NutrientMatrix.from_arrays(
+        values,
+        np.zeros_like(values),
+        arrays["unit_amounts"],
+        arrays["taxa"],
+        arrays["taxon_bits"],
+    )
+    worker["arrays"] = arrays
+    worker["presolve"] = catalogue.presolve
+
+# solves one (id, target) pair in a worker. the recipe is given as indices
+# into all_products, with amounts in each product's unit_measure
+def solve_target(item: tuple[str, Target]) -> dict[str, Any]:
+    id, target = item
+    matrix: NutrientMatrix = worker["matrix"]
+    arrays = worker["arrays"]
+
+    target = { req: (0, None) for req in required_nutrients } | target
+    keys, signs, goals = target_rows(target)
+    amounts = matrix.sparse_rows(keys, signs)
+
+    lower, upper = arrays["lower"].copy(), arrays["upper"].copy()
+    if worker["presolve"]:
+        exact_rows = [ i for i, k in enumerate(keys) if keys.count(k) == 2 ]
+        dropped = dominated_columns(
+            amounts, np.array(goals), arrays["prices"], lower, upper,
+            arrays["unit_amounts"], exact_rows=exact_rows,
+        )
+        upper[dropped] = 0.0
+
+    cols = np.flatnonzero(upper > 0)
+    model = Model(
+        cols=cols,
+        prices=arrays["prices"][cols],
+        amounts=amounts[:, cols],
+        goals=np.array(goals, dtype=float),
+        lower=lower[cols],
+        upper=upper[cols],
+    )
+
+    result = solve_highs(model) if len(cols) > 0 else None
+    if result is None:
+        return { "id": id, "status": "infeasible" }
+
+    xs, optimal = result
+    used = np.flatnonzero(xs > 0)
+    products = cols[used]
+
+    nutrient_keys = list(target.keys())
+    totals = xs[used] @ matrix.columns(nutrient_keys, products)
+
+    return {
+        "id": id,
+        "status": "optimal" if optimal else "feasible",
+        "total_price": float(model.prices[used] @ xs[used]),
+        "products": products.tolist(),
+        "amounts": (xs[used] * matrix.unit_amounts[products]).tolist(),
+        "total_nutrients": dict(zip(nutrient_keys, totals.tolist())),
+    }
+
+# solves every target against the problem's products and filters, yielding
+# results in the order they finish, with products given by id
+def solve_batch(
+    problem: Problem,
+    targets: Iterable[tuple[str, Target]],
+    processes: int | None = None,
+    presolve: bool = True,
+    chunksize: int = 4,
+) -> Iterator[dict[str, Any]]:
+    catalogue, handles = share_problem(problem, presolve)
+
+    try:
+        with multiprocessing.Pool(processes, initializer=attach_worker, initargs=(catalogue,)) as pool:
+            for result in pool.imap_unordered(solve_target, targets, chunksize=chunksize):
+                if "products" in result:
+                    result["products"] = [ problem.all_products.ids[i] for i in result["products"] ]
+                yield result
+    finally:
+        for shm in handles:
+            shm.close()
+            shm.unlink()
+
+def read_targets(path: str) -> Iterator[tuple[str, Target]]:
+    with open(path) as f:
+        for i, line in enumerate(f):
+            if not line.strip():
+                continue
+
+            entry = json.loads(line)
+            target = { k: (mn, mx) for k, (mn, mx) in entry["target"].items() }
+            yield str(entry.get("id", i)), target
+
+class JsonlWriter:
+    def __init__(self, path: str):
+        self.file = open(path, "w")
+
+    def write(self, result: dict[str, Any]):
+        self.file.write(json.dumps(result) + "\n")
+
+    def close(self):
+        self.file.close()
+
+# buffers results into row groups. needs pyarrow
+class ParquetWriter:
+    def __init__(self, path: str, row_group: int = 1024):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("writing parquet needs pyarrow (pip install pyarrow)")
+
+        self.pa = pyarrow
+        self.schema = pyarrow.schema([
+            ("id", pyarrow.string()),
+            ("status", pyarrow.string()),
+            ("total_price", pyarrow.float64()),
+            ("products", pyarrow.list_(pyarrow.string())),
+            ("amounts", pyarrow.list_(pyarrow.float64())),
+            ("total_nutrients", pyarrow.string()),
+        ])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        self.row_group = row_group
+        self.rows: list[dict[str, Any]] = []
+
+    def write(self, result: dict[str, Any]):
+        row = dict(result)
+        row["total_nutrients"] = json.dumps(result["total_nutrients"]) if "total_nutrients" in result else None
+        self.rows.append(row)
+
+        if len(self.rows) >= self.row_group:
+            self.flush()
+
+    def flush(self):
+        if len(self.rows) > 0:
+            self.writer.write_table(self.pa.Table.from_pylist(self.rows, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="solve a batch of targets")
+    parser.add_argument("targets", help="JSONL file of targets")
+    parser.add_argument("output", help="where to write results (.jsonl or .parquet)")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--no-presolve", action="store_true")
+    args = parser.parse_args()
+
+    targets = list(read_targets(args.targets))
+    print(f"{len(targets)} targets")
+
+    start = time.perf_counter()
+    problem = Problem.load(dict(target), get_engine())
+
+    problem.taxonomy_blacklist = list(taxonomy_blacklist)
+    problem.taxonomy_whitelist = list(taxonomy_whitelist)
+    problem.reapply_filter()
+    print(f"{len(problem.products)} products found, loaded in {time.perf_counter() - start:.1f}s")
+
+    writer = ParquetWriter(args.output) if args.output.endswith(".parquet") else JsonlWriter(args.output)
+    start = last_report = time.perf_counter()
+    solved, failed = 0, 0
+
+    try:
+        for result in solve_batch(problem, targets, args.processes, not args.no_presolve):
+            writer.write(result)
+
+            if result["status"] == "infeasible":
+                failed += 1
+            else:
+                solved += 1
+
+            now = time.perf_counter()
+            if now - last_report > 2 or solved + failed == len(targets):
+                done = solved + failed
+                print(f"{done}/{len(targets)} done ({failed} infeasible), {done / (now - start):.1f} solves/s", file=sys.stderr)
+                last_report = now
+    finally:
+        writer.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,383 @@
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable
+from scripts.metaheuristic import solve_de
+from scripts.solver import *
+from src.matrix import NUTRIENTS
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+"""
+Benchmarks the solver against synthetic catalogues, so that changes can be
+compared between commits without the real database. Catalogues of each size
+are generated once into data/bench/ (with the same schema, taxonomy shape,
+nutrient sparsity and mix of g/ml/serving products as the real one) and then
+reused.
+
+Each phase is timed separately: loading the catalogue cold (from the
+database, writing its snapshot) and warm (from the snapshot), filtering,
+building the model (with presolve), solving with each backend, and turning
+the answer into a Solution. Results are written as JSON.
+
+Run with: python3 -m scripts.bench --sizes 1000,10000 --output bench.json
+"""
+
+# categories which products are generated under, beneath the root. each is
+# (id, parent, name, kind), using the real ids wherever the solver's target or
+# lists mention them. made-up ids start at 3000000
+categories: list[tuple[int, int, str, str]] = [
+    (1018859, 0, "Bakery", "bakery"),
+    (1018785, 1018859, "Bread", "bakery"),
+    (3000001, 0, "Dairy, eggs & chilled", "dairy"),
+    (1019075, 3000001, "Dairy & eggs", "dairy"),
+    (1019084, 3000001, "Desserts", "sweet"),
+    (1019106, 3000001, "Fruit juice & drinks", "drink"),
+    (1019176, 3000001, "Vegetarian, vegan & dairy free", "protein"),
+    (3000002, 3000001, "Chilled ready meals", "meal"),
+    (1019463, 0, "Drinks", "drink"),
+    (3000003, 0, "Food cupboard", "cupboard"),
+    (1019495, 3000003, "Biscuits & crackers", "sweet"),
+    (1019516, 3000003, "Pulses & beans", "protein"),
+    (1019510, 3000003, "Canned fish", "protein"),
+    (1019538, 3000003, "Canned vegetables", "produce"),
+    (1019573, 3000003, "Cereals", "cupboard"),
+    (1019598, 3000003, "Confectionary", "sweet"),
+    (1019630, 3000003, "Cooking ingredients & oils", "fat"),
+    (1019694, 3000003, "Crisps, nuts & snacking fruit", "fat"),
+    (1019794, 3000003, "Rice, pasta & noodles", "cupboard"),
+    (1019837, 3000003, "Sugar & home baking", "sweet"),
+    (3000004, 0, "Frozen", "meal"),
+    (1019924, 3000004, "Fish & seafood", "protein"),
+    (1019934, 3000004, "Fruit, veg & herbs", "produce"),
+    (1019999, 3000004, "Vegetarian & meat free", "protein"),
+    (1020082, 0, "Fruit & veg", "produce"),
+    (3000005, 0, "Meat & fish", "protein"),
+    (1020363, 3000005, "Fish & seafood", "protein"),
+    (3000006, 3000005, "Beef", "protein"),
+    (3000007, 0, "Household", "household"),
+    (3000008, 0, "Beer, wine & spirits", "drink"),
+]
+
+# per kind: (kcal per 100 (min, max), share of energy from protein, fat and
+# carbohydrate, how micronutrient-dense it is, relative weights of g/ml/serving)
+kinds: dict[str, tuple[tuple[float, float], tuple[float, float, float], float, tuple[float, float, float]]] = {
+    "produce": ((15, 90), (0.15, 0.1, 0.75), 4.0, (0.8, 0.0, 0.2)),
+    "bakery": ((220, 420), (0.14, 0.2, 0.66), 1.0, (0.6, 0.0, 0.4)),
+    "dairy": ((40, 400), (0.25, 0.5, 0.25), 1.5, (0.5, 0.4, 0.1)),
+    "drink": ((0, 60), (0.02, 0.0, 0.98), 0.3, (0.0, 1.0, 0.0)),
+    "cupboard": ((100, 380), (0.13, 0.07, 0.8), 1.2, (0.9, 0.0, 0.1)),
+    "protein": ((80, 280), (0.6, 0.35, 0.05), 1.5, (0.8, 0.0, 0.2)),
+    "sweet": ((250, 550), (0.05, 0.4, 0.55), 0.4, (0.7, 0.0, 0.3)),
+    "fat": ((450, 900), (0.1, 0.85, 0.05), 0.8, (0.6, 0.4, 0.0)),
+    "meal": ((90, 250), (0.2, 0.35, 0.45), 1.0, (0.6, 0.0, 0.4)),
+    "household": ((0, 0), (0, 0, 0), 0.0, (0.3, 0.4, 0.3)),
+}
+
+# what's on a label. everything else only comes from matched reference items
+label_nutrients = ["energy", "protein", "fat", "sat_fat", "carbohydrate", "total_sugar", "fibre", "sodium"]
+
+# what a 2000kcal diet is expected to contain of each micronutrient, for
+# scaling the generated amounts: the solver's minimums, where it has them
+def daily_amounts() -> dict[str, float]:
+    amounts = { n: 1e-3 for n in NUTRIENTS if n not in label_nutrients }
+
+    for n, (mn, _) in target.items():
+        if n in amounts and mn is not None:
+            amounts[n] = mn
+
+    return amounts
+
+def nutrient_values(
+    rng: random.Random,
+    kind: str,
+    micros: bool,
+    sparsity: float,
+) -> dict[str, float | None]:
+    (emin, emax), (p, f, c), density, _ = kinds[kind]
+    energy = rng.uniform(emin, emax)
+
+    shares = [ rng.uniform(0.5, 1.5) * s for s in (p, f, c) ]
+    total = sum(shares) or 1
+    p, f, c = [ s / total for s in shares ]
+
+    values = {
+        "energy": energy,
+        "protein": energy * p / 4,
+        "fat": energy * f / 9,
+        "carbohydrate": energy * c / 4,
+    }
+    values["sat_fat"] = values["fat"] * rng.uniform(0.05, 0.6)
+    values["total_sugar"] = values["carbohydrate"] * rng.uniform(0, 0.7)
+    values["sodium"] = rng.uniform(0, 0.8) if kind not in ["produce", "drink"] else rng.uniform(0, 0.02)
+    if rng.random() < 0.75:
+        values["fibre"] = rng.uniform(0, 8) if kind != "drink" else 0.0
+
+    if micros:
+        for n, daily in daily_amounts().items():
+            if rng.random() < sparsity:
+                values[n] = daily / 2000 * max(energy, 100) * density * rng.lognormvariate(0, 1)
+
+    # every row needs every column, to be inserted together
+    return { n: None for n in NUTRIENTS } | values
+
+def category_tree(rng: random.Random, subcategories: int) -> list[tuple[int, int, str, str]]:
+    tree = [ (0, -1, "Groceries", "household") ] + categories
+    parents = { parent for _, parent, _, _ in categories }
+
+    next_id = 4000000
+    for id, _, name, kind in categories:
+        if id in parents:
+            continue
+
+        for k in range(subcategories):
+            tree.append((next_id, id, f"{name} {k + 1}", kind))
+            next_id += 1
+
+    return tree
+
+# writes a synthetic catalogue of n products to path, with core inserts since
+# going through the ORM would take far longer than anything being measured
+def generate_catalogue(path: str, n: int, seed: int = 0):
+    rng = random.Random(seed)
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    engine = get_engine(f"sqlite:///{path}")
+
+    tree = category_tree(rng, 3)
+    parent_of = { id: parent for id, parent, _, _ in tree }
+    leaves = [ (id, kind) for id, _, _, kind in tree if id not in parent_of.values() ]
+
+    taxonomies = [
+        { "id": id, "name": name, "parent_id": None if parent < 0 else parent }
+        for id, parent, name, _ in tree
+    ]
+
+    # reference items (like cofid), which products get matched against
+    references = []
+    for k in range(max(50, n // 20)):
+        kind = rng.choice([ kind for kind in kinds if kind != "household" ])
+        references.append((kind, {
+            "id": k + 1,
+            "name": f"reference {kind} {k}",
+            "source": "cofid",
+            **nutrient_values(rng, kind, True, 0.8),
+        }))
+
+    by_kind: dict[str, list[int]] = {}
+    for i, (kind, _) in enumerate(references):
+        by_kind.setdefault(kind, []).append(i)
+
+    products, links, nutritions, product_nutritions = [], [], [], []
+    next_nutrition = len(references) + 1
+
+    for i in range(n):
+        leaf, kind = rng.choice(leaves)
+        measure = rng.choices(["g", "ml", "serving"], weights=kinds[kind][3])[0]
+        unit_amount = 1000.0 if measure != "serving" else float(rng.choice([1, 1, 4, 6, 12]))
+        id = str(5000000 + i)
+
+        products.append({
+            "id": id,
+            "name": f"synthetic {kind} {i}",
+            "description": f"a synthetic {kind} product",
+            "url": f"https://example.com/{id}",
+            "unit_price": round(rng.lognormvariate(1.5, 0.7), 2),
+            "unit_measure": measure,
+            "unit_amount": unit_amount,
+            "retail_price": round(rng.uniform(0.3, 10), 2),
+            "is_alcohol": False,
+            "brand": rng.choice(["Sainsbury's", "Sainsbury's", None, "Brand A", "Brand B"]),
+        })
+
+        taxon = leaf
+        while taxon >= 0:
+            links.append({ "product_id": id, "taxonomy_id": taxon })
+            taxon = parent_of[taxon]
+
+        if kind == "household":
+            continue
+
+        amount = 100.0 if measure != "serving" else 1.0
+
+        # most foods have a label
+        if rng.random() < 0.8:
+            nutritions.append({
+                "id": next_nutrition,
+                "name": products[-1]["name"],
+                "source": "sainsbury's",
+                **nutrient_values(rng, kind, False, 0.0),
+            })
+            product_nutritions.append({
+                "product_id": id, "nutrition_id": next_nutrition, "measure": measure,
+                "amount": amount, "source": "known", "scale": 1.0, "sureness": 1.0,
+            })
+            next_nutrition += 1
+
+        # and most are matched to a reference item or two, some too unsure to use
+        for _ in range(rng.choices([0, 1, 2], weights=[0.2, 0.6, 0.2])[0]):
+            sureness = round(rng.uniform(0.5, 1.0), 2)
+            product_nutritions.append({
+                "product_id": id, "nutrition_id": rng.choice(by_kind[kind]) + 1, "measure": measure,
+                "amount": amount, "source": f"matched (sureness {sureness}) from cofid",
+                "scale": rng.uniform(0.8, 1.2), "sureness": sureness,
+            })
+
+    with engine.begin() as conn:
+        conn.execute(Taxonomy.__table__.insert(), taxonomies) # type: ignore
+        conn.execute(Nutrition.__table__.insert(), [ r for _, r in references ] + nutritions) # type: ignore
+        conn.execute(Product.__table__.insert(), products) # type: ignore
+        conn.execute(ProductTaxonomy.__table__.insert(), links) # type: ignore
+        conn.execute(ProductNutrition.__table__.insert(), product_nutritions) # type: ignore
+
+    engine.dispose()
+
+# each backend, given a model and a time limit in seconds (or None)
+backends: dict[str, Callable[[Model, float | None], tuple[np.ndarray, bool] | None]] = {
+    "highs": lambda model, limit: solve_highs(model, time_limit=limit),
+    "scip": lambda model, limit: solve_scip(model, time_limit=limit),
+    "cbc": lambda model, limit: solve_cbc(model, time_limit=limit),
+    "de": lambda model, limit: solve_de(model, time_limit=limit, milp_seed=False),
+    "shortlist+de": lambda model, limit: solve_de(model, time_limit=limit),
+}
+
+# records how long the body takes as phases[name]
+@contextmanager
+def timed(phases: dict[str, float], name: str):
+    start = time.perf_counter()
+    yield
+    phases[name] = time.perf_counter() - start
+
+# benchmarks each backend on the catalogue at path, returning a result for each
+def bench_catalogue(path: str, backend_names: list[str], time_limit: float | None = None) -> list[dict[str, Any]]:
+    phases: dict[str, float] = {}
+    engine = get_engine(f"sqlite:///{path}")
+
+    # collating is part of ingest, not loading, so it's done (for catalogues
+    # generated before it was) ahead of the timings
+    with Session(engine) as session:
+        get_collated(session, [])
+
+    # loaded as the solver does: cold, from the database (writing the
+    # snapshot), and then warm, from the snapshot
+    snapshot = snapshot_path(path)
+    if os.path.exists(snapshot):
+        os.remove(snapshot)
+
+    with timed(phases, "load_cold"):
+        Problem.load(dict(target), engine)
+
+    with timed(phases, "load_warm"):
+        problem = Problem.load(dict(target), engine)
+
+    with timed(phases, "filter"):
+        problem.taxonomy_blacklist = list(taxonomy_blacklist)
+        problem.taxonomy_whitelist = list(taxonomy_whitelist)
+        problem.reapply_filter()
+
+    with timed(phases, "model"):
+        model = problem.model()
+
+    results = []
+    for name in backend_names:
+        solve_phases: dict[str, float] = {}
+
+        with timed(solve_phases, "solve"):
+            result = backends[name](model, time_limit) if len(model.cols) > 0 else None
+
+        price, items = None, None
+        if result is not None:
+            with timed(solve_phases, "solution"):
+                solution = problem.make_model_recipe(model, result[0])
+            price, items = solution.total_price, len(solution.recipe)
+
+        results.append({
+            "products": len(problem.all_products),
+            "allowed": int(problem.allowed.sum()),
+            "columns": len(model.cols),
+            "backend": name,
+            "status": "no solution" if result is None else "optimal" if result[1] else "feasible",
+            "total_price": price,
+            "items": items,
+            "phases": phases | solve_phases,
+        })
+
+    engine.dispose()
+    return results
+
+def git_commit() -> str | None:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True,
+        )
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the solver on synthetic catalogues")
+    parser.add_argument("--sizes", default="1000,10000,50000,200000", help="comma-separated numbers of products")
+    parser.add_argument("--backends", default="highs,scip", help=f"comma-separated, from {','.join(backends)}")
+    parser.add_argument("--time-limit", type=float, default=60, help="seconds per solve (0 for none)")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dir", default="data/bench", help="where generated catalogues are kept")
+    parser.add_argument("--output", default=None, help="JSON file to write (default: stdout)")
+    args = parser.parse_args()
+
+    sizes = [ int(s) for s in args.sizes.split(",") ]
+    backend_names = args.backends.split(",")
+    for name in backend_names:
+        if name not in backends:
+            parser.error(f"unknown backend: {name}")
+
+    Path(args.dir).mkdir(parents=True, exist_ok=True)
+    results = []
+
+    for size in sizes:
+        path = os.path.join(args.dir, f"catalogue-{size}-{args.seed}.db")
+
+        if not os.path.exists(path):
+            start = time.perf_counter()
+            generate_catalogue(path, size, args.seed)
+            print(f"generated {size} products in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+        for run in range(args.repeat):
+            for result in bench_catalogue(path, backend_names, args.time_limit or None):
+                result["run"] = run
+                results.append(result)
+
+                phases = ", ".join(f"{k} {v:.3f}s" for k, v in result["phases"].items())
+                print(f"{size} products, {result['backend']} ({result['status']}): {phases}", file=sys.stderr)
+
+    report = {
+        "commit": git_commit(),
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "seed": args.seed,
+        "time_limit": args.time_limit or None,
+        "results": results,
+    }
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -140,6 +140,9 @@ def assign_all_taxonomies(session: Session):
         for top_level in taxonomy:
             assign_taxonomies(session, top_level, seen_pairs, prior=[root])
 
+    session.commit()
+    refresh_taxonomy_closure(session)
+
 def main(session: Session):
     for filepath in Path('data/out').rglob('*.json'):
         if filepath.is_file():
@@ -156,6 +159,8 @@ def main(session: Session):
     assign_all_taxonomies(session)
     session.commit()
 
+    refresh_product_search(session)
+
 if __name__ == "__main__":
     with Session(engine) as session:
         main(session)
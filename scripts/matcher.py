@@ -1,5 +1,5 @@
 from sqlmodel import Session, delete, select
-from src.data import Nutrition, Product, ProductNutrition, get_engine
+from src.data import Nutrition, Product, ProductNutrition, get_engine, refresh_collated
 from typing import Any
 from scripts import embedding
 
@@ -141,7 +141,9 @@ def main(session: Session):
 
     session.commit()
 
-    print(f"committed new product-nutrition pairs")
+    refresh_collated(session, [ pn.product_id for pn, _, _, _ in new_pairings if pn.product_id ])
+
+    print(f"committed new product-nutrition pairs, and refreshed their collated nutrition")
 
 if __name__ == "__main__":
     engine = get_engine()
@@ -0,0 +1,372 @@
+from dataclasses import dataclass, field
+from typing import Any
+from scripts.solver import *
+
+import argparse
+import multiprocessing
+
+"""
+Searches for recipes with differential evolution, for objectives the MILP
+can't express: a penalty on recipes leaning on only a few products (variety),
+a cap on how many products may come from one category, and a bonus for
+products which are liked (palatability).
+
+The search is over a shortlist of products, taken from column generation
+(see generate_columns in solver.py): those the LP relaxation used, and then
+those with the next best reduced costs. The MILP's recipe over the shortlist
+seeds the population, so with no preferences set it's the one to beat. Products
+outside the shortlist can't be used however well they're liked, so --size
+may need raising when the preferences pull far from the cheapest recipe.
+
+Every generation is scored at once: the population is one array, split into
+a chunk per worker process, and each chunk is scored with a few array
+operations against the nutrient matrix, so the cost of a generation hardly
+depends on its size.
+
+Run with: python3 -m scripts.metaheuristic --variety 1 --max-per-taxon 1019075=2
+"""
+
+# what the recipe should be like, besides cheap. variety is the price (in £)
+# of a recipe made of just one product, falling to 0 as it's spread evenly
+# over more; max_per_taxon caps the products used from each taxon; and
+# palatability gives a score per product id, whose mass-weighted mean over
+# the recipe is worth palatability_weight £ per point
+@dataclass
+class Preferences:
+    variety: float = 0.0
+    max_per_taxon: dict[int, int] = field(default_factory=dict)
+    palatability: dict[str, float] = field(default_factory=dict)
+    palatability_weight: float = 0.0
+
+# the objective over a shortlist of products, for a whole population at once.
+# each row of xs is a recipe, in units of each product's unit_amount
+@dataclass
+class Fitness:
+    prices: np.ndarray
+    amounts: np.ndarray
+    goals: np.ndarray
+    lower: np.ndarray
+    upper: np.ndarray
+    unit_amounts: np.ndarray
+
+    # taxa[i, j] is whether product j is in the i-th capped taxon
+    taxa: np.ndarray
+    caps: np.ndarray
+    scores: np.ndarray
+    preferences: Preferences
+
+    # the price per whole goal a recipe falls short of any row by
+    penalty: float = 100.0
+
+    # xs with each product either unused, or within its semi-continuous
+    # bounds: anything less than half of the lower bound counts as unused
+    def decode(self, xs: np.ndarray) -> np.ndarray:
+        return np.where(xs < self.lower / 2, 0.0, np.clip(xs, self.lower, self.upper))
+
+    # how far each recipe falls short of each row, as a fraction of its goal
+    def violations(self, xs: np.ndarray) -> np.ndarray:
+        over = xs @ self.amounts.T - self.goals
+        return np.maximum(over, 0.0) / np.maximum(np.abs(self.goals), 1e-9)
+
+    def __call__(self, xs: np.ndarray) -> np.ndarray:
+        xs = self.decode(np.atleast_2d(xs))
+        prefs = self.preferences
+
+        score = xs @ self.prices
+        score += self.penalty * self.violations(xs).sum(axis=1)
+
+        mass = xs * self.unit_amounts
+        total = mass.sum(axis=1, keepdims=True)
+        shares = np.divide(mass, total, out=np.zeros_like(mass), where=total > 0)
+
+        # a Herfindahl index: 1 for a single product, 1/n for n even ones
+        if prefs.variety:
+            score += prefs.variety * (shares ** 2).sum(axis=1)
+
+        if len(self.caps) > 0:
+            counts = (xs > 0).astype(float) @ self.taxa.T
+            score += self.penalty * np.maximum(counts - self.caps, 0.0).sum(axis=1)
+
+        if prefs.palatability_weight:
+            score -= prefs.palatability_weight * (shares @ self.scores)
+
+        return score
+
+# set up in each worker by attach_worker
+worker: dict[str, Any] = {}
+
+def attach_worker(fitness: Fitness):
+    worker["fitness"] = fitness
+
+def evaluate_chunk(xs: np.ndarray) -> np.ndarray:
+    return worker["fitness"](xs)
+
+# scores a population a chunk per worker process, or all at once in this one
+class Evaluator:
+    def __init__(self, fitness: Fitness, processes: int):
+        self.fitness = fitness
+        self.processes = processes
+        self.pool = multiprocessing.Pool(processes, initializer=attach_worker, initargs=(fitness,)) if processes > 1 else None
+
+    def __call__(self, xs: np.ndarray) -> np.ndarray:
+        if self.pool is None:
+            return self.fitness(xs)
+
+        chunks = np.array_split(xs, self.processes)
+        return np.concatenate(self.pool.map(evaluate_chunk, chunks))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+# the columns of a model worth searching over: those column generation used,
+# and then the next best priced, up to size
+def shortlist(model: Model, size: int) -> np.ndarray:
+    upper = model.upper
+    seed = seed_columns(model.amounts, model.goals, model.prices, upper > 0)
+    cols, reduced, bound = generate_columns(model.amounts, model.goals, model.prices, upper, seed)
+
+    if bound is None:
+        return np.zeros(0, dtype=int)
+
+    rest = np.flatnonzero(upper > 0)
+    rest = rest[~np.isin(rest, cols)]
+    rest = rest[np.argsort(reduced[rest], kind="stable")]
+
+    return np.sort(np.concatenate((cols, rest[:max(0, size - len(cols))])))
+
+# a population around x0: random recipes over the whole box are nearly all far
+# from meeting the target, so each member is x0 scaled a little, with a few
+# other products brought in at around their lower bounds
+def initial_population(
+    x0: np.ndarray,
+    lower: np.ndarray,
+    upper: np.ndarray,
+    size: int,
+    rng: np.random.Generator,
+    added: int = 3,
+) -> np.ndarray:
+    n = len(x0)
+    xs = x0 * rng.uniform(0.7, 1.3, (size, n))
+
+    rows = np.repeat(np.arange(size), added)
+    cols = rng.integers(0, n, size * added)
+    xs[rows, cols] += rng.uniform(lower[cols], 2 * lower[cols] + 1e-9)
+
+    xs[0] = x0
+    return np.clip(xs, 0.0, upper)
+
+# the time left until deadline (a time.perf_counter()), or None without one
+def remaining(deadline: float | None) -> float | None:
+    return None if deadline is None else max(0.0, deadline - time.perf_counter())
+
+# the best recipe differential evolution finds over the columns of a model in
+# candidates, along with whether it meets every row (to within tolerance, as
+# a fraction of each goal) and every cap. it stops after the given number of
+# generations, at the deadline (a time.perf_counter()), or once the scores
+# are all within convergence (relative) of each other. unless milp_seed is
+# unset, the population starts around the MILP's recipe over the candidates,
+# which is solved within the same deadline
+def evolve(
+    model: Model,
+    candidates: np.ndarray,
+    fitness: Fitness,
+    processes: int = 1,
+    deadline: float | None = None,
+    milp_seed: bool = True,
+    generations: int = 500,
+    popsize: int = 15,
+    crossover: float = 0.7,
+    convergence: float = 1e-3,
+    seed: int | None = None,
+    tolerance: float = 1e-3,
+) -> tuple[np.ndarray, bool]:
+    sub = Model(
+        cols=model.cols[candidates],
+        prices=model.prices[candidates],
+        amounts=model.amounts[:, candidates],
+        goals=model.goals,
+        lower=model.lower[candidates],
+        upper=model.upper[candidates],
+    )
+
+    # the MILP's recipe over the same products, as a starting point, or else
+    # the middle of each product's bounds
+    start = None
+    if milp_seed and remaining(deadline) != 0.0:
+        start = solve_highs(sub, time_limit=remaining(deadline))
+
+    x0 = start[0] if start is not None else (sub.lower + sub.upper) / 2
+    rng = np.random.default_rng(seed)
+
+    evaluate = Evaluator(fitness, processes)
+
+    # best/1/bin, a generation at a time: each member's trial is the best
+    # member plus a dithered multiple of the difference of two others, crossed
+    # with the member, and replaces it if it scores better
+    try:
+        xs = initial_population(x0, sub.lower, sub.upper, popsize * len(candidates), rng)
+        scores = evaluate(xs)
+        size, n = xs.shape
+
+        for _ in range(generations):
+            best = xs[np.argmin(scores)]
+
+            # two others for each member: drawn from the rest, by skipping it
+            others = rng.integers(0, size - 1, (size, 2))
+            others += others >= np.arange(size)[:, None]
+
+            scale = rng.uniform(0.5, 1.0, (size, 1))
+            mutants = best + scale * (xs[others[:, 0]] - xs[others[:, 1]])
+
+            cross = rng.random((size, n)) < crossover
+            cross[np.arange(size), rng.integers(0, n, size)] = True
+            trials = np.clip(np.where(cross, mutants, xs), 0.0, sub.upper)
+
+            trial_scores = evaluate(trials)
+            better = trial_scores < scores
+            xs[better], scores[better] = trials[better], trial_scores[better]
+
+            if scores.std() <= convergence * abs(scores.mean()):
+                break
+            if deadline is not None and time.perf_counter() > deadline:
+                break
+    finally:
+        evaluate.close()
+
+    xs = fitness.decode(xs[np.argmin(scores)][None])
+    feasible = fitness.violations(xs).max() <= tolerance
+    if len(fitness.caps) > 0:
+        feasible &= bool(((xs > 0).astype(float) @ fitness.taxa.T <= fitness.caps).all())
+
+    all_xs = np.zeros(len(model.cols))
+    all_xs[candidates] = xs[0]
+
+    return all_xs, bool(feasible)
+
+def make_fitness(
+    model: Model,
+    candidates: np.ndarray,
+    preferences: Preferences,
+    unit_amounts: np.ndarray,
+    taxa: np.ndarray,
+    caps: np.ndarray,
+    scores: np.ndarray,
+) -> Fitness:
+    return Fitness(
+        prices=model.prices[candidates],
+        amounts=model.amounts[:, candidates].toarray(),
+        goals=model.goals,
+        lower=model.lower[candidates],
+        upper=model.upper[candidates],
+        unit_amounts=unit_amounts,
+        taxa=taxa,
+        caps=caps,
+        scores=scores,
+        preferences=preferences,
+    )
+
+# a Backend, like solve_highs, for comparing with the MILP on what both can
+# express: the cheapest recipe, with no preferences. never proven optimal.
+# without milp_seed, the search is differential evolution alone
+def solve_de(
+    model: Model,
+    time_limit: float | None = None,
+    size: int = 60,
+    processes: int = 1,
+    seed: int | None = None,
+    milp_seed: bool = True,
+) -> tuple[np.ndarray, bool] | None:
+    deadline = None if time_limit is None else time.perf_counter() + time_limit
+    candidates = shortlist(model, size)
+    if len(candidates) == 0:
+        return None
+
+    fitness = make_fitness(
+        model, candidates, Preferences(),
+        np.ones(len(candidates)), np.zeros((0, len(candidates))), np.zeros(0), np.zeros(len(candidates)),
+    )
+    xs, feasible = evolve(model, candidates, fitness, processes, deadline, milp_seed, seed=seed)
+
+    return (xs, False) if feasible else None
+
+# the best recipe found for a problem with preferences, if it meets the target
+def solve_preferences(
+    problem: Problem,
+    preferences: Preferences,
+    time_limit: float | None = None,
+    size: int = 60,
+    processes: int | None = None,
+    seed: int | None = None,
+) -> Solution | None:
+    deadline = None if time_limit is None else time.perf_counter() + time_limit
+
+    # dominance presolve only holds for price alone, and could drop the very
+    # products the preferences favour
+    model = problem.model(presolve=False)
+    candidates = shortlist(model, size)
+    if len(candidates) == 0:
+        return None
+
+    products = model.cols[candidates]
+    capped = sorted(preferences.max_per_taxon)
+
+    fitness = make_fitness(
+        model, candidates, preferences,
+        problem.matrix.unit_amounts[products],
+        np.array([ problem.matrix.in_any([t])[products] for t in capped ], dtype=float).reshape(len(capped), len(products)),
+        np.array([ preferences.max_per_taxon[t] for t in capped ], dtype=float),
+        np.array([ preferences.palatability.get(problem.all_products.ids[i], 0.0) for i in products ]),
+    )
+
+    with instruments.phase("metaheuristic", candidates=len(candidates)) as stats:
+        xs, feasible = evolve(model, candidates, fitness, processes or os.cpu_count() or 1, deadline, seed=seed)
+        stats.update(feasible=feasible, fitness=float(fitness(xs[candidates])[0]))
+
+    if not feasible:
+        return None
+
+    return problem.make_model_recipe(model, xs, with_sensitivity=False)
+
+def main():
+    parser = argparse.ArgumentParser(description="find a cheap recipe with preferences the MILP can't express")
+    parser.add_argument("--variety", type=float, default=0.0, help="£ for a recipe of a single product")
+    parser.add_argument("--max-per-taxon", action="append", default=[], metavar="TAXON=N")
+    parser.add_argument("--palatability", help="json file of product id -> score")
+    parser.add_argument("--palatability-weight", type=float, default=1.0, help="£ per point of score")
+    parser.add_argument("--size", type=int, default=60, help="products to search over")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--time-limit", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--compare", action="store_true", help="also solve the plain MILP, for comparison")
+    args = parser.parse_args()
+
+    preferences = Preferences(
+        variety=args.variety,
+        max_per_taxon={ int(t): int(n) for t, n in (c.split("=") for c in args.max_per_taxon) },
+        palatability=json.load(open(args.palatability)) if args.palatability else {},
+        palatability_weight=args.palatability_weight if args.palatability else 0.0,
+    )
+
+    problem = Problem.load(dict(target), get_engine())
+    problem.taxonomy_blacklist = list(taxonomy_blacklist)
+    problem.taxonomy_whitelist = list(taxonomy_whitelist)
+    problem.reapply_filter()
+    print(f"{len(problem.products)} products found")
+
+    if args.compare:
+        start = time.perf_counter()
+        milp = problem.solve(time_limit=args.time_limit)
+        print(f"MILP: {f'£{milp.total_price:.2f}' if milp else 'no recipe'} in {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    solution = solve_preferences(problem, preferences, args.time_limit, args.size, args.processes, args.seed)
+    print(f"evolution: {f'£{solution.total_price:.2f}' if solution else 'no recipe'} in {time.perf_counter() - start:.2f}s")
+
+    if solution:
+        print()
+        solution.print()
+
+if __name__ == "__main__":
+    main()
@@ -367,4 +367,6 @@ if __name__ == "__main__":
 
                             session.commit()
 
-        print(f"finished {n}")
+        refresh_collated(session)
+
+        print(f"finished {n}, and collated the nutrition of every product")
@@ -0,0 +1,37 @@
+from scripts.solver import *
+from src.snapshot import Snapshot
+
+import argparse
+
+"""
+Exports everything the solver needs from the catalogue (prices, units, the
+collated nutrient matrix and taxonomy membership) to a snapshot, which Problem
+can open in milliseconds without touching the database. The solver, the API
+and the other scripts use it whenever it's up to date, and rebuild it when
+it isn't; this just builds it ahead of time, e.g. after collating or matching.
+
+Run with: python3 -m scripts.snapshot
+"""
+
+def main():
+    parser = argparse.ArgumentParser(description="export a snapshot of the catalogue for the solver")
+    parser.add_argument("--output", default=snapshot_path())
+    args = parser.parse_args()
+
+    engine = get_engine()
+    start = time.perf_counter()
+
+    with Session(engine) as session:
+        products, matrix = load_catalogue(session)
+
+    print(f"loaded {len(products)} products in {time.perf_counter() - start:.2f}s")
+
+    Snapshot.write(args.output, products, matrix, catalogue_version(), global_id_blacklist)
+    print(f"wrote {args.output} ({os.path.getsize(args.output) / 1e6:.1f}MB)")
+
+    start = time.perf_counter()
+    Problem.from_snapshot(dict(target), Snapshot.open(args.output))
+    print(f"opened in {(time.perf_counter() - start) * 1e3:.1f}ms")
+
+if __name__ == "__main__":
+    main()
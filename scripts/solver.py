@@ -1,397 +1,536 @@
 from dataclasses import dataclass
-from typing import Tuple
+from typing import Any, Callable, Tuple
+from scipy import sparse
 from scipy.optimize import linprog, differential_evolution, minimize
 from mealpy import GA, PSO, SMA, FloatVar, SHADE, IntegerVar
-from ortools.linear_solver import pywraplp
+from ortools.linear_solver import pywraplp, linear_solver_pb2
+from src import problem as core
 from src.data import *
+from src.cache import DiskCache, catalogue_version
+from src.metrics import JsonLines, instruments
+from src.problem import *
 
+import argparse
+import highspy
+import json
 import pulp
 import mealpy
+import multiprocessing
 import numpy as np
+import os
+import queue
+import signal
+import sys
+import time
+
+# an equivalent MILP of a model, for backends without semi-continuous
+# variables: each x_i gets a binary used_i, with
+# lower_i * used_i <= x_i <= upper_i * used_i. used_i costs item_cost, to
+# prefer fewer items
+def ortools_proto(model: Model, item_cost: float = 0.0) -> linear_solver_pb2.MPModelProto:
+    proto = linear_solver_pb2.MPModelProto()
+    n = len(model.cols)
+
+    for i in range(n):
+        proto.variable.add(
+            name=f"x_{i}",
+            lower_bound=0,
+            upper_bound=np.inf,
+            objective_coefficient=model.prices[i],
+        )
 
-Target = dict[str, tuple[float | None, float | None]]
-
-target: Target = {
-    "energy": (2100, 2300),
-    # "protein": (85, None),
-    # "fat": (50, 75),
-    # "sat_fat": (None, 15),
-    # "carbohydrate": (280, 350),
-    # "total_sugar": (150, None),
-    "fibre": (30, None),
-    "sodium": (2400e-3, 3600e-3),
-
-    "potassium": (3500e-3, None),
-    "calcium": (1000e-3, None),
-    "magnesium": (350e-3, None),
-    # "chromium": (0, None),
-    # "molybdenum": (0, None),
-    "phosphorus": (550e-3, None),
-    "iron": (8.7e-3, None),
-    "copper": (1.4e-3, None),
-    "zinc": (9.5e-3, None),
-    # "manganese": (0e-3, None),
-    "selenium": (75e-6, None),
-    "iodine": (140e-6, None),
-
-    "vit_a": (700e-6, None),
-    "vit_c": (40e-3, None),
-    "vit_d": (10e-6, None),
-    "vit_e": (4e-3, None),
-    "vit_k": (75e-6, None),
-    "vit_b1": (1e-3, None),
-    "vit_b2": (1.3e-3, None),
-    "vit_b3": (16.5e-3, None),
-    "vit_b5": (5e-3, None),
-    "vit_b6": (1.4e-3, None),
-    # "vit_b7": (0e-6, None),
-    "vit_b9": (400e-6, None),
-    "vit_b12": (15e-6, None),
-}
+    for i in range(n):
+        proto.variable.add(
+            name=f"used_{i}",
+            lower_bound=0,
+            upper_bound=1,
+            is_integer=True,
+            objective_coefficient=item_cost,
+        )
 
-target: Target = {
-    "energy": (2100, 2300),
-    "protein": (85, None),
-    "fat": (50, None),
-    "sat_fat": (None, 15),
-    "carbohydrate": (280, None),
-    "total_sugar": (None, 35),
-    "fibre": (30, None),
-    "sodium": (2400e-3, 3600e-3),
-
-    "potassium": (3500e-3, None),
-    "calcium": (1000e-3, None),
-    "magnesium": (350e-3, None),
-    # "chromium": (0, None),
-    # "molybdenum": (0, None),
-    "phosphorus": (550e-3, None),
-    "iron": (8.7e-3, None),
-    "copper": (1.4e-3, None),
-    "zinc": (9.5e-3, None),
-    # "manganese": (0e-3, None),
-    "selenium": (75e-6, None),
-    "iodine": (140e-6, None),
-
-    "vit_a": (700e-6, None),
-    "vit_c": (40e-3, None),
-    "vit_d": (10e-6, None),
-    "vit_e": (4e-3, None),
-    "vit_k": (75e-6, None),
-    "vit_b1": (1e-3, None),
-    "vit_b2": (1.3e-3, None),
-    "vit_b3": (16.5e-3, None),
-    "vit_b5": (5e-3, None),
-    "vit_b6": (1.4e-3, None),
-    # "vit_b7": (0e-6, None),
-    "vit_b9": (400e-6, None),
-    "vit_b12": (15e-6, None),
-
-    # at least 500g of fruit & veg
-    "taxon:1020082": (750, None),
-
-    # at most 200g of bread
-    "taxon:1018785": (None, 200),
-
-    # at most 50g of "home baking"
-    "taxon:1019837": (None, 50),
-}
+    # each constraint's coefficients are copied straight out of the
+    # sparse matrix
+    amounts = model.amounts
+    for i, goal in enumerate(model.goals):
+        row = slice(amounts.indptr[i], amounts.indptr[i + 1])
+
+        proto.constraint.add(
+            lower_bound=-np.inf,
+            upper_bound=goal,
+            var_index=amounts.indices[row].tolist(),
+            coefficient=amounts.data[row].tolist(),
+        )
 
-global_id_blacklist = [
-    "8092711", # Wrong price (beef)
-    "6567540", # Wrong price (noodles)
-    "7855654", # Wrong price (couscous)
-    "7863309", # Some chicken that's categorised as fruit & veg?
-    "7861621", # Some chicken that's categorised as fruit & veg?
-    "8105729", # Bitter gourd (sounds yucky)
-    "8168098", # Yoghurt with incorrect vit D
-    "8079236", # Cheestrings, incorrect B6
-    "8035841", # Beansprouts, out-of-date price
-    "7377250", # Party pretzels, incorrect sodium
-    "7518068", # Lime leaves, incorrect amount
-    "7518051", # Bay leaves, incorrect mapping
-]
+    for i in range(n):
+        proto.constraint.add(
+            lower_bound=0,
+            upper_bound=np.inf,
+            var_index=[i, n + i],
+            coefficient=[1, -model.lower[i]],
+        )
+        proto.constraint.add(
+            lower_bound=-np.inf,
+            upper_bound=0,
+            var_index=[i, n + i],
+            coefficient=[1, -model.upper[i]],
+        )
 
-min_to_use = {
-    "g": 50,
-    "ml": 50,
-    "serving": 0.5,
-}
+    return proto
 
-max_to_use = {
-    "g": 500,
-    "ml": 500,
-    "serving": 5,
+scip_statuses = {
+    pywraplp.Solver.OPTIMAL: "optimal",
+    pywraplp.Solver.FEASIBLE: "feasible",
+    pywraplp.Solver.INFEASIBLE: "infeasible",
+    pywraplp.Solver.UNBOUNDED: "unbounded",
+    pywraplp.Solver.ABNORMAL: "abnormal",
+    pywraplp.Solver.NOT_SOLVED: "not solved",
 }
 
-@dataclass
-class Solution:
-    recipe: list[tuple[Product, float]]
-    item_prices: list[float]
-    total_nutrients: dict[str, float]
-    calculated_energy: float
-    total_price: float
-    target: Target
-
-    def __init__(self, recipe: list[tuple[Product, float]], target: Target):
-        self.recipe = recipe
-        self.total_nutrients = {}
-        self.target = target
-
-        # calculate total nutrition
-        for k in target.keys():
-            total = 0
-
-            for prod, units in recipe:
-                val, _, _ = get_nutr_val(prod, k)
-                total += val * units / prod.unit_amount
-
-            self.total_nutrients[k] = total
-
-        # calculate prices
-        self.total_price = 0
-        for prod, units in recipe:
-            price = units * prod.unit_price / prod.unit_amount
-            amount = units
-            self.total_price += price
-
-        self.total_energy = self.total_nutrients["protein"] * 4.084\
-            + self.total_nutrients["carbohydrate"] * 4.184\
-            + self.total_nutrients["fat"] * 9.396
-
-    def print_nutrition(self):
-        for k in self.target.keys():
-            if k == "energy":
-                # this gets printed at the end, anyway
-                continue
+def solve_scip(
+    model: Model,
+    threads: int = 1,
+    item_cost: float = 0.0,
+    verbose: bool = False,
+    time_limit: float | None = None,
+    gap: float | None = None,
+) -> tuple[np.ndarray, bool] | None:
+    solver: pywraplp.Solver = pywraplp.Solver.CreateSolver("SCIP")
+    assert solver is not None
+
+    error = solver.LoadModelFromProto(ortools_proto(model, item_cost))
+    assert error == "", error
+
+    n = len(model.cols)
+    variables = solver.variables()
+    xs, used = variables[:n], variables[n:]
+
+    solver.SetNumThreads(threads)
+    if time_limit is not None:
+        solver.SetTimeLimit(int(time_limit * 1000))
+    if verbose:
+        solver.EnableOutput()
+        print(f"solving, with {solver.NumVariables()} variables")
+    if gap is not None:
+        solver.SetSolverSpecificParametersAsString(f"limits/gap = {gap}")
 
-            val = self.total_nutrients[k]
-            disp = show_g(val)
+    with instruments.phase("solve", backend="scip", **model.counts()) as stats:
+        status = solver.Solve()
+        stats.update(
+            status=scip_statuses.get(status, str(status)),
+            nodes=solver.nodes(),
+            iterations=solver.iterations(),
+        )
 
-            best = max(
-                self.recipe,
-                key=lambda p: get_nutr_val(p[0], k)[0] * p[1] / p[0].unit_amount
-            )
-            best_val = show_g(get_nutr_val(best[0], k)[0] * best[1] / best[0].unit_amount)
+    if status not in [pywraplp.Solver.OPTIMAL, pywraplp.Solver.FEASIBLE]:
+        return None
 
-            print(f" {disp:>8}  {k:<16}  ** {best_val} from {best[1]:.2f} {best[0].unit_measure} x {best[0].name}")
+    x_vals = np.array([ x.solution_value() if u.solution_value() else 0.0
+            for x, u in zip(xs, used) ])
+    return x_vals, status == pywraplp.Solver.OPTIMAL
 
-    def print_prices(self):
-        for prod, units in sorted(self.recipe, key=lambda i: i[1]):
-            price = units * prod.unit_price / prod.unit_amount
-            measure = prod.unit_measure
-            print(f"   £{price:>5.2f}  {units:.2f} {prod.unit_measure} x {prod.name} ({prod.id})")
+def solve_cbc(
+    model: Model,
+    threads: int = 1,
+    item_cost: float = 0.0,
+    time_limit: float | None = None,
+    gap: float | None = None,
+) -> tuple[np.ndarray, bool] | None:
+    prob = pulp.LpProblem("diet", pulp.LpMinimize)
+    n = len(model.cols)
 
-    def print(self):
-        self.print_nutrition()
-        print()
-        self.print_prices()
-        print(f"  ------")
-        print(f"  energy:  {self.total_energy:.2f}kcal")
-        print(f"  total:   £{self.total_price:.2f}")
-
-def show_g(val: float) -> str:
-    if val < 1e-3:
-        disp = f"{val * 1e+6:.2f}µg"
-    elif val < 1:
-        disp = f"{val * 1e+3:.2f}mg"
-    elif val <= 500:
-        disp = f"{val:.2f}g"
-    else:
-        disp = f"{val / 1e+3:.2f}kg"
+    xs = [ pulp.LpVariable(f"x_{i}", lowBound=0) for i in range(n) ]
+    used = [ pulp.LpVariable(f"used_{i}", cat=pulp.LpBinary) for i in range(n) ]
 
-    return disp
+    prob += pulp.lpDot(model.prices.tolist(), xs) + item_cost * pulp.lpSum(used)
 
-@dataclass
-class Problem:
-    all_nutrient_amounts: list[list[float]]
-    all_prices: list[float]
-    all_bounds: list[tuple[float | None, float | None]]
-    all_products: list[Product]
-
-    goals: list[float]
-    goals_map: dict[str, int]
-    nutrient_amounts: list[list[float]]
-    prices: list[float]
-    bounds: list[tuple[float | None, float | None]]
-    products: list[Product]
-
-    target: Target
-    banned_ids: list[str]
-    taxonomy_whitelist: list[int]
-    taxonomy_blacklist: list[int]
-
-    def __init__(self, target: Target, session: Session):
-        self.banned_ids = []
-        self.taxonomy_blacklist = []
-        self.taxonomy_whitelist = []
-
-        self.load_products(session)
-        assert self.all_products is not None
-
-        self.set_target(target)
-
-    def set_target(self, target: Target):
-        for req in ["protein", "carbohydrate", "fat"]:
-            if req not in target:
-                target[req] = (0, None)
-
-        self.goals, self.goals_map = [], {}
-        self.target = target
-
-        for k, (mn, mx) in self.target.items():
-            if mn != None:
-                self.goals_map[k] = len(self.goals)
-                self.goals.append(-mn)
-            if mx != None:
-                self.goals_map[k] = len(self.goals)
-                self.goals.append(mx)
-
-        self.all_nutrient_amounts = [[] for _ in self.goals]
-        self.all_prices, self.all_bounds = [], []
-
-        for prod in self.all_products:
-            self.all_prices.append(prod.unit_price)
-            self.all_bounds.append((0.0, None))
-
-            i = 0
-            for k, (mn, mx) in target.items():
-                val, _, _ = get_nutr_val(prod, k)
-
-                if mn != None:
-                    self.all_nutrient_amounts[i].append(-val)
-                    i += 1
-
-                if mx != None:
-                    self.all_nutrient_amounts[i].append(val)
-                    i += 1
-
-        self.reapply_filter()
-
-    def load_products(self, session: Session):
-        self.all_products = get_products(
-            session,
-            load_all=True,
-            id_blacklist=global_id_blacklist,
-            only_proper_measures=True,
+    amounts = model.amounts
+    for i, goal in enumerate(model.goals):
+        row = slice(amounts.indptr[i], amounts.indptr[i + 1])
+        terms = zip((xs[j] for j in amounts.indices[row]), amounts.data[row].tolist())
+        prob += pulp.LpAffineExpression(terms) <= goal
+
+    for i in range(n):
+        prob += xs[i] >= model.lower[i] * used[i]
+        prob += xs[i] <= model.upper[i] * used[i]
+
+    with instruments.phase("solve", backend="cbc", **model.counts()) as stats:
+        prob.solve(pulp.PULP_CBC_CMD(msg=False, threads=threads, timeLimit=time_limit, gapRel=gap))
+        stats["status"] = pulp.LpStatus[prob.status].lower()
+
+    if prob.sol_status not in [pulp.LpSolutionOptimal, pulp.LpSolutionIntegerFeasible]:
+        return None
+
+    x_vals = np.array([ (x.value() or 0.0) if (u.value() or 0.0) > 0.5 else 0.0
+            for x, u in zip(xs, used) ])
+    return x_vals, prob.sol_status == pulp.LpSolutionOptimal
+
+# the products to seed column generation with: for each row that needs
+# something (a minimum), the candidate giving the most of it per £
+def seed_columns(amounts: sparse.csr_matrix, goals: np.ndarray, prices: np.ndarray, candidates: np.ndarray) -> np.ndarray:
+    seed = set()
+
+    for i in np.flatnonzero(goals < 0):
+        start, end = amounts.indptr[i], amounts.indptr[i + 1]
+        cols, vals = amounts.indices[start:end], -amounts.data[start:end]
+
+        keep = candidates[cols] & (vals > 0)
+        if keep.any():
+            cols, vals = cols[keep], vals[keep]
+            seed.add(int(cols[np.argmax(vals / prices[cols])]))
+
+    return np.array(sorted(seed), dtype=int)
+
+# finds the columns worth giving the MILP, without handing the whole catalogue
+# to a solver. the LP relaxation (each product anywhere from 0 to its upper
+# bound) is solved over a few columns, starting from seed, and the duals of
+# its rows price every other candidate at once: those with negative reduced
+# costs could make it cheaper, so the batch most negative are added and it's
+# solved again, until none are left. each row has a slack, scaled to its goal
+# and very dear, so the restricted LP is never infeasible.
+#
+# returns the columns added, the reduced costs of every column in the last
+# round (for picking more) and the LP's objective, a lower bound on the price
+# of any recipe, or None if even the LP over every candidate is infeasible
+def generate_columns(
+    amounts: sparse.csr_matrix,
+    goals: np.ndarray,
+    prices: np.ndarray,
+    upper: np.ndarray,
+    seed: np.ndarray,
+    batch: int = 50,
+    max_rounds: int = 200,
+    penalty: float = 1e4,
+) -> tuple[np.ndarray, np.ndarray, float | None]:
+    rows = len(goals)
+    candidates = upper > 0
+    by_col = amounts.tocsc()
+
+    highs = highspy.Highs()
+    highs.setOptionValue("output_flag", False)
+
+    highs.addRows(
+        rows, np.full(rows, -highspy.kHighsInf), goals,
+        0, np.zeros(rows, dtype=np.int32), np.zeros(0, dtype=np.int32), np.zeros(0),
+    )
+
+    # slack i loosens row i by a fraction of its goal, for penalty per goal
+    scale = np.maximum(np.abs(goals), 1e-9)
+    highs.addCols(
+        rows, np.full(rows, penalty), np.zeros(rows), np.full(rows, highspy.kHighsInf),
+        rows, np.arange(rows, dtype=np.int32), np.arange(rows, dtype=np.int32), -scale,
+    )
+
+    def add(cols: np.ndarray):
+        block = by_col[:, cols]
+        highs.addCols(
+            len(cols), prices[cols], np.zeros(len(cols)), upper[cols],
+            block.nnz, block.indptr[:-1].astype(np.int32),
+            block.indices.astype(np.int32), block.data,
         )
 
-    def product_allowed(self, product: Product) -> bool:
-        if product.id in self.banned_ids:
-            return False
+    added = np.zeros(len(prices), dtype=bool)
+    seed = seed[candidates[seed]]
+    add(seed)
+    added[seed] = True
 
-        if any(t.id in self.taxonomy_blacklist for t in product.taxonomies) and\
-                not any(t.id in self.taxonomy_whitelist for t in product.taxonomies):
-            return False
+    reduced = np.zeros(len(prices))
+    for _ in range(max_rounds):
+        highs.run()
+        if highs.getModelStatus() != highspy.HighsModelStatus.kOptimal:
+            return np.flatnonzero(added), reduced, None
 
-        if len(product.nutritions) == 0:
-            return False
+        duals = np.array(highs.getSolution().row_dual)
+        reduced = prices - amounts.T @ duals
 
-        _, src, _ = get_nutr_val(product, "carbohydrate")
-        if src == "no source":
-            return False
+        entering = np.flatnonzero(candidates & ~added & (reduced < -1e-9))
+        if len(entering) == 0:
+            break
 
-        return True
+        entering = entering[np.argsort(reduced[entering])[:batch]]
+        add(entering)
+        added[entering] = True
 
-    def set_bounds(self, product_id: str, min: float | None, max: float | None = None):
-        prod = next(p for p in self.all_products if p.id == product_id)
-        if not self.product_allowed(prod):
-            print("bounds set for disallowed product:", prod.name)
-        idx = self.all_products.index(prod)
-        self.all_bounds[idx] = (min, max)
+    slacks = np.array(highs.getSolution().col_value[:rows])
+    if (slacks > 1e-9).any():
+        return np.flatnonzero(added), reduced, None
 
-    def reapply_filter(self):
-        self.nutrient_amounts = [[] for _ in self.goals]
-        self.prices = []
-        self.bounds = []
-        self.products = []
+    return np.flatnonzero(added), reduced, highs.getInfo().objective_function_value
 
-        for i, prod in enumerate(self.all_products):
-            if self.product_allowed(prod):
-                self.products.append(prod)
-                self.prices.append(self.all_prices[i])
-                self.bounds.append(self.all_bounds[i])
-                for j, ns in enumerate(self.nutrient_amounts):
-                    ns.append(self.all_nutrient_amounts[j][i])
+Backend = Callable[..., tuple[np.ndarray, bool] | None]
 
-    def solve(self) -> Solution | None:
-        if len(self.products) == 0:
+# what solve_portfolio races by default: (name, backend, options)
+portfolio: list[tuple[str, Backend, dict[str, Any]]] = [
+    ("highs", solve_highs, {}),
+    ("highs-heuristic", solve_highs, { "mip_heuristic_effort": 0.3 }),
+    ("scip", solve_scip, {}),
+    ("cbc", solve_cbc, {}),
+]
+
+def race_worker(name: str, backend: Backend, options: dict[str, Any], model: Model, results: multiprocessing.Queue):
+    # own process group, so that any solver subprocesses (pulp runs cbc as a
+    # separate binary) are killed along with this one
+    os.setpgrp()
+
+    start, result = time.perf_counter(), None
+
+    # a backend that fails still reports, as finding no solution, so that
+    # race isn't left waiting for it
+    try:
+        result = backend(model, **options)
+    except Exception as e:
+        print(f"portfolio: {name} failed: {e}")
+    finally:
+        results.put((name, result, time.perf_counter() - start))
+
+# runs each backend on the model in its own process, returning the name of the
+# first one to prove optimality along with its answer. the others are killed.
+# if none prove optimality, the best feasible answer wins
+def race(
+    model: Model,
+    backends: list[tuple[str, Backend, dict[str, Any]]] = portfolio,
+) -> tuple[str, np.ndarray] | None:
+    results = multiprocessing.Queue()
+    procs = [
+        multiprocessing.Process(target=race_worker, args=(name, backend, options, model, results), daemon=True)
+        for name, backend, options in backends
+    ]
+
+    for proc in procs:
+        proc.start()
+
+    winner, fallback = None, None
+    pending = { name: proc for (name, _, _), proc in zip(backends, procs) }
+
+    try:
+        while pending:
+            try:
+                name, result, elapsed = results.get(timeout=0.5)
+            except queue.Empty:
+                # a worker that died (killed, or failing to even start) puts
+                # nothing. anything it did put is in the queue by the time it
+                # has exited, so it's only counted once the queue is checked
+                # again after seeing it dead
+                dead = [ name for name, proc in pending.items() if not proc.is_alive() ]
+                try:
+                    name, result, elapsed = results.get(timeout=0.1)
+                except queue.Empty:
+                    for name in dead:
+                        print(f"portfolio: {name} exited ({pending.pop(name).exitcode}) without a result")
+                    continue
+
+            if pending.pop(name, None) is None:
+                continue
+
+            if result is None:
+                print(f"portfolio: {name} found no solution after {elapsed:.2f}s")
+                continue
+
+            x, optimal = result
+            if optimal:
+                print(f"portfolio: {name} won in {elapsed:.2f}s")
+                winner = (name, x)
+                break
+
+            print(f"portfolio: {name} finished in {elapsed:.2f}s without proving optimality")
+            if fallback is None or model.prices @ x < model.prices @ fallback[1]:
+                fallback = (name, x)
+    finally:
+        for proc in procs:
+            if proc.is_alive():
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    proc.kill()
+            proc.join()
+
+    return winner or fallback
+
+# the Problem of src/problem.py, along with the ways of solving it which need
+# backends the API doesn't: column generation, SCIP, and the portfolio race
+class Problem(core.Problem):
+    # solves by column generation (see generate_columns), for catalogues too
+    # big to hand the solver whole. the MILP is only given the columns the LP
+    # priced in, along with the extra with the next best reduced costs, so
+    # the recipe is the cheapest using those products, which is usually the
+    # cheapest outright. if there's none, more columns are let in until there
+    # is one or every candidate has been
+    def solve_colgen(
+        self,
+        time_limit: float | None = None,
+        gap: float | None = None,
+        batch: int = 50,
+        extra: int = 200,
+    ) -> Solution | None:
+        _, upper = self.column_bounds(presolve=True)
+        candidates = upper > 0
+        if not candidates.any():
             return None
 
-        bounds = []
-        for prod, (mn, mx) in zip(self.products, self.bounds):
-            min_amount = min_to_use[prod.unit_measure] / prod.unit_amount
-            max_amount = max_to_use[prod.unit_measure] / prod.unit_amount
-
-            bounds.append((
-                max(mn or min_amount, min_amount),
-                min(mx or max_amount, max_amount)
-            ))
-
-        result = linprog(
-            c=self.prices,
-            A_ub=self.nutrient_amounts,
-            b_ub=self.goals,
-            bounds=bounds,
-            method="highs",
-            integrality=2, # semi-continuous
-        )
+        goals = np.array(self.goals, dtype=float)
+        amounts = self.all_nutrient_amounts
 
-        if not result.success:
+        with instruments.phase("colgen", candidates=int(candidates.sum())) as stats:
+            seed = seed_columns(amounts, goals, self.all_prices, candidates)
+            cols, reduced, bound = generate_columns(amounts, goals, self.all_prices, upper, seed, batch)
+            stats.update(seed=len(seed), generated=len(cols), feasible=bound is not None)
+
+        if bound is None:
             return None
 
-        return self.make_recipe(result.x)
+        # the rest of the candidates, in order of how nearly they'd enter
+        rest = np.flatnonzero(candidates)
+        rest = rest[np.argsort(reduced[rest], kind="stable")]
+        rest = rest[~np.isin(rest, cols)]
 
-    def solve_ortools(self) -> Solution | None:
-        solver: pywraplp.Solver = pywraplp.Solver.CreateSolver("SCIP")
-        assert solver is not None
+        while True:
+            model = self.model(presolve=False, within=np.concatenate((cols, rest[:extra])))
+            result = solve_highs(model, time_limit=time_limit, gap=gap)
 
-        xs = [ solver.NumVar(0, solver.infinity(), f"x_{i}") for i in range(len(self.products)) ]
-        used = [ solver.BoolVar(f"used_{i}") for i in range(len(self.products)) ]
+            if result is not None or extra >= len(rest):
+                break
 
-        total_price = solver.Sum(xs[i] * self.prices[i] for i in range(len(self.products)))
+            extra *= 4
 
-        solver.Minimize(total_price + solver.Sum(used) * 0.5)
-        # solver.Minimize(solver.Sum(used))
-        # solver.Add(total_price <= 4.0)
-        # solver.Add(solver.Sum(used) <= 5)
+        if result is None:
+            return None
 
-        for i, goal in enumerate(self.goals):
-            amount = solver.Sum(
-                xs[j] * self.nutrient_amounts[i][j]
-                for j in range(len(self.products))
-                if self.nutrient_amounts[i][j] != 0)
+        return self.make_model_recipe(model, result[0])
 
-            solver.Add(amount <= goal)
+    def solve_ortools(
+        self,
+        threads: int = 8,
+        time_limit: float | None = None,
+        gap: float | None = None,
+    ) -> Solution | None:
+        model = self.model()
+        result = solve_scip(model, threads=threads, item_cost=0.5, verbose=True, time_limit=time_limit, gap=gap)
 
-        for i, prod in enumerate(self.products):
-            at_least = min_to_use[prod.unit_measure] / prod.unit_amount
-            at_most = max_to_use[prod.unit_measure] / prod.unit_amount
-            solver.Add(xs[i] >= at_least * used[i])
-            solver.Add(xs[i] <= at_most * used[i])
+        if result is None:
+            return None
 
-        solver.SetNumThreads(8)
-        solver.EnableOutput()
-        # solver.SetSolverSpecificParametersAsString("limits/gap = 0.1")
-        print(f"solving, with {solver.NumVariables()} variables")
-        status = solver.Solve()
+        return self.make_model_recipe(model, result[0])
 
-        if status in [pywraplp.Solver.OPTIMAL, pywraplp.Solver.FEASIBLE]:
-            x_vals = [ x.solution_value() if u.solution_value() else 0.0
-                    for x, u in zip(xs, used) ]
-            return self.make_recipe(x_vals)
+    # races several backends against each other, in separate processes
+    def solve_portfolio(
+        self,
+        backends: list[tuple[str, Backend, dict[str, Any]]] = portfolio,
+    ) -> Solution | None:
+        if not self.allowed.any():
+            return None
 
-        return None
+        model = self.model()
+        result = race(model, backends)
 
-    def make_recipe(self, xs: list[float]) -> Solution:
-        recipe = []
-        for i, v in enumerate(xs):
-            prod = self.products[i]
-            amount = v * prod.unit_amount
+        if result is None:
+            return None
 
-            if amount > 0:
-                recipe.append((prod, amount))
+        return self.make_model_recipe(model, result[1])
 
-        return Solution(recipe, self.target)
+# a HiGHS model of a Problem which is kept in memory between solves. changes
+# made to the problem (bans, filters, set_bounds, new target bounds) are pushed
+# to the model as deltas on the affected columns and rows, and each re-solve
+# is seeded with the previous solution
+@dataclass
+class SolverSession:
+    problem: Problem
+    highs: highspy.Highs
+
+    # what the model currently holds. lower, upper and goals are the model's
+    # own arrays, kept up to date with every change
+    model: Model
+    goal_keys: list[tuple[str, float]]
+    lower: np.ndarray
+    upper: np.ndarray
+    goals: np.ndarray
+    last_x: np.ndarray | None
+
+    # the catalogue the model was built over, and whether it's yet to be solved
+    matrix: NutrientMatrix
+    cold: bool
+
+    def __init__(self, problem: Problem):
+        self.problem = problem
+        self.highs = highspy.Highs()
+        self.highs.setOptionValue("output_flag", False)
+        self.build()
+
+    # (re)builds the whole model from the problem
+    def build(self):
+        model = self.problem.model(all=True, presolve=False)
+
+        self.model = model
+        self.matrix = self.problem.matrix
+        self.goal_keys = self.problem.goal_keys
+        self.lower, self.upper = model.lower, model.upper
+        self.goals = model.goals
+
+        self.highs.passModel(model.highs_lp())
+        self.last_x = None
+        self.cold = True
+
+    def set_column_bounds(self, cols: np.ndarray, lower: np.ndarray, upper: np.ndarray):
+        self.highs.changeColsBounds(len(cols), cols, lower, upper)
+        self.lower[cols] = lower
+        self.upper[cols] = upper
+
+    # a deactivated column is just one fixed at 0
+    def deactivate(self, cols: np.ndarray):
+        zeros = np.zeros(len(cols))
+        self.set_column_bounds(cols, zeros, zeros)
+
+    def set_goals(self, rows: np.ndarray, goals: np.ndarray):
+        lower = np.full(len(rows), -highspy.kHighsInf)
+        self.highs.changeRowsBounds(len(rows), rows, lower, goals)
+        self.goals[rows] = goals
+
+    # pushes whatever has changed in the problem since the last solve
+    def sync(self):
+        problem = self.problem
+
+        # new rows, or a new catalogue (see Problem.set_catalogue), need a
+        # new model
+        if problem.goal_keys != self.goal_keys or problem.matrix is not self.matrix \
+            or len(problem.all_products) != len(self.model.cols):
+            self.build()
+            return
+
+        lower, upper = problem.column_bounds()
+        cols = np.flatnonzero((lower != self.lower) | (upper != self.upper))
+        if len(cols) > 0:
+            self.set_column_bounds(cols, lower[cols], upper[cols])
+
+        goals = np.array(problem.goals, dtype=float)
+        rows = np.flatnonzero(goals != self.goals)
+        if len(rows) > 0:
+            self.set_goals(rows, goals[rows])
+
+    # emits a "resolve" event with its seconds, as either a cold solve (of a
+    # newly built model) or a warm one, so the two can be compared
+    def solve(self) -> Solution | None:
+        with instruments.phase("resolve") as stats:
+            self.sync()
+            stats["kind"] = "cold" if self.cold else "warm"
+
+            if self.last_x is not None:
+                # the last solution, with any newly disallowed columns zeroed.
+                # if it's still feasible HiGHS starts from it as its incumbent
+                seed = highspy.HighsSolution()
+                seed.col_value = np.where(self.last_x <= self.upper, self.last_x, 0.0)
+                seed.value_valid = True
+                self.highs.setSolution(seed)
+
+            self.highs.run()
+            self.cold = False
+
+            status = self.highs.getModelStatus()
+            stats["status"] = self.highs.modelStatusToString(status).lower()
+
+        if status != highspy.HighsModelStatus.kOptimal:
+            self.last_x = None
+            return None
+
+        self.last_x = np.array(self.highs.getSolution().col_value)
+        return self.problem.make_model_recipe(self.model, self.last_x)
 
 def make_goals() -> tuple[list[float], dict[str, int]]:
     goals = []
@@ -408,75 +547,44 @@ def make_goals() -> tuple[list[float], dict[str, int]]:
     return goals, goal_map
 
 def main():
-    engine = get_engine()
+    parser = argparse.ArgumentParser(description="find the cheapest recipe which meets the target")
+    parser.add_argument("--colgen", action="store_true", help="solve by column generation, for very broad whitelists")
+    parser.add_argument("--events", action="store_true", help="print what the solver does, as json, to stderr")
+    args = parser.parse_args()
 
-    with Session(engine) as session:
-        problem = Problem(target, session)
+    if args.events:
+        instruments.sinks.append(JsonLines(sys.stderr))
 
-    problem.set_target(target)
+    method = "colgen" if args.colgen else "highs"
+    cache = DiskCache()
+    key = solve_key(target, [], taxonomy_whitelist, taxonomy_blacklist, {}, catalogue_version(), method)
 
-    problem.taxonomy_blacklist = [
-        0
-    ]
+    if (cached := cache.get(key)) is not None:
+        print("found cached solution")
+        recipe = Solution.from_dict(cached)
+    else:
+        problem = Problem.load(target, get_engine())
+        problem.taxonomy_blacklist = list(taxonomy_blacklist)
+        problem.taxonomy_whitelist = list(taxonomy_whitelist)
 
-    problem.taxonomy_whitelist = [
-        1018859, # Bakery
-        # Dairy, eggs & chilled
-          1019075, # Dairy & eggs
-          1019084, # Desserts
-          1019106, # Fruit juice & drinks
-          1019176, # Vegetarian, vegan & dairy free (chilled)
-        1019463, # Drinks
-        # Food cupboard
-          1019495, # Biscuits & crackers
-          # Canned ...
-            1019496, # Baked beans & canned pasta
-            1019510, # Canned fish
-            1019511, # Canned fruit
-            1019514, # Olives & antipasti
-            1019515, # Pickled food
-            1019516, # Pulses & beans
-            1019528, # Soups
-            1019530, # Tomatoes
-            1019538, # Vegetables
-            1019539, # Vegetarian
-          1019573, # Cereals
-          1019598, # Confectionary
-          1019630, # Cooking ingredients & oils
-          1019666, # Cooking sauces & meal kits
-          1019694, # Crisps, nuts & snacking fruit
-          1019744, # Fruit & desserts
-          1019754, # Jams, honey & spreads
-          1019794, # Rice, pasta & noodles
-          # 1019837, # Sugar & home baking
-          1019850, # Table sauces etc
-          1019869, # Tea, coffee & hot drinks
-        # Frozen
-          1019895, # Chips, potatoes & rice
-          1019902, # Desserts & pastry
-          1019924, # Fish & seafood
-          1019934, # Fruit, veg & herbs
-          1019943, # Ice cream & ice
-          1019974, # Pizza & garlic bread
-          1019988, # Vegan
-          1019999, # Vegetarian & meat free
-          1020000, # Yorkshires & roast accompaniments
-        1020082, # Fruit & veg
-        # Meat & fish
-          1020363, # Fish & seafood
-          1020378, # Meat free
-    ]
+        # problem.set_bounds("6334094", 2)
+        problem.reapply_filter()
+        print(f"{len(problem.products)} products found")
 
-    # problem.set_bounds("6334094", 2)
-    problem.reapply_filter()
-    print(f"{len(problem.products)} products found")
+        recipe = problem.solve_colgen() if args.colgen else problem.solve()
+        print(f"presolve dropped {problem.dropped.sum()} dominated products")
 
-    recipe = problem.solve()
+        if not recipe:
+            print("failed to solve")
+            return
 
-    if recipe:
-        recipe.print()
-    else:
-        print("failed to solve")
+        cache.put(key, recipe.to_dict())
+
+    recipe.print()
+
+    if recipe.sensitivity:
+        print()
+        recipe.sensitivity.print(recipe.target)
 
 if __name__ == "__main__":
     main()
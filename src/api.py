@@ -1,16 +1,31 @@
 from fastapi import APIRouter, Depends, HTTPException, Query
 from fastapi.applications import FastAPI
+from fastapi.responses import Response, StreamingResponse
 from sqlalchemy.sql import func
 from sqlmodel import Session
 from src.data import *
+from src.jobs import SolveJobResponse, SolveQueue, SolveRequest
+from src.metrics import Metrics, instruments
+from src.taxonomy import TAXON_FIELDS, TaxonomyCache
 
 router = APIRouter()
 engine = get_engine()
+solve_queue = SolveQueue(engine)
+
+metrics = Metrics()
+instruments.sinks.append(metrics)
+
+taxonomy_cache = TaxonomyCache()
 
 def get_session():
     with Session(engine) as session:
         yield session
 
+# products under a taxon, optionally matching a search (every word, each as a
+# prefix, against the name, brand and description), best matches first. under
+# the root, nearly every product is in, so each is checked as it comes up and
+# the query stops at the limit; under any other taxon, its products are
+# gathered first from the index
 @router.get("/product/search")
 async def product_query(
     id: str | None = Query(default=None),
@@ -20,16 +35,23 @@ async def product_query(
     offset: int = Query(default=0, ge=0),
     session: Session = Depends(get_session),
 ) -> list[Product]:
-    query = select(Product).where(
-        Product.taxonomies.any(Taxonomy.id == taxon) # type: ignore
-    ).order_by(Product.id).limit(limit).offset(offset)
+    ensure_taxonomy_closure(session)
+    under = under_any([taxon]) if taxon == 0 else Product.id.in_(products_under([taxon])) # type: ignore
+    query = select(Product).where(under).limit(limit).offset(offset)
 
     if id:
         query = query.where(Product.id == id)
 
     if name:
-        for word in name.split():
-            query = query.where(Product.name.ilike(f"%{word}%")) # type: ignore
+        # a search with no words in it matches nothing
+        if (match := search_query(name)) is None:
+            return []
+
+        ensure_product_search(session)
+        matches = search_matches(match)
+        query = query.join(matches, matches.c.id == Product.id).order_by(matches.c.rank)
+    else:
+        query = query.order_by(Product.id)
 
     prods = session.exec(query)
     return list(prods.all())
@@ -62,24 +84,49 @@ async def product_by_id(
     if not prod:
         return None
 
-    resp = collate_nutrition(prod)
+    resp = collate_nutrition(prod, session.get(CollatedNutrition, prod.id))
     return resp
 
+# served from the cached tree: the whole of it is already serialised, and any
+# other subtree is put together from it in memory. with depth, only that many
+# levels of children come back, each node with its child_count and
+# product_count, so a client can expand nodes as they're opened. fields (comma
+# separated, from TAXON_FIELDS) picks what each node has
 @router.get("/taxonomy", response_model=TaxonomyResponse | None)
 @router.get("/taxonomy/{id}", response_model=TaxonomyResponse | None)
 async def get_taxon_info(
-    id: int | None = 0,
+    id: int = 0,
+    depth: int | None = Query(default=None, ge=0),
+    fields: str | None = Query(default=None),
     session: Session = Depends(get_session)
 ):
-    root = session.get(Taxonomy, id)
-    if root is None:
-        return root
+    if id == 0 and depth is None and fields is None:
+        return Response(taxonomy_cache.whole(session), media_type="application/json")
+
+    picked = TAXON_FIELDS[:5] if depth is None else TAXON_FIELDS
+    if fields is not None:
+        picked = [ f.strip() for f in fields.split(",") if f.strip() ]
+
+        if unknown := [ f for f in picked if f not in TAXON_FIELDS ]:
+            raise HTTPException(status_code=400, detail=f"unknown fields: {', '.join(unknown)}")
 
-    if root.parent is None:
-        return root
+    counts = taxonomy_cache.product_counts(session) if "product_count" in picked else {}
+    tree = taxonomy_cache.get(session)
 
-    return taxonomy_reponse(root)
+    return Response(
+        tree.serialise(id, depth=depth, fields=picked, product_counts=counts),
+        media_type="application/json",
+    )
 
+# the taxa from the root down to this one
+@router.get("/taxonomy/{id}/breadcrumb", response_model=list[Taxonomy])
+async def get_taxon_breadcrumb(
+    id: int,
+    session: Session = Depends(get_session)
+):
+    return taxonomy_breadcrumb(session, id)
+
+# the cached tree, cut down to the taxa the product is in
 @router.get("/taxonomy/containing-product/{id}", response_model=TaxonomyResponse | None)
 async def get_taxonomies_containing_product(
     id: int,
@@ -89,12 +136,13 @@ async def get_taxonomies_containing_product(
     if not prod:
         return None
 
-    root = session.get(Taxonomy, 0)
-    assert root is not None
-
-    taxonomy_ids = [ taxon.id for taxon in prod.taxonomies ]
+    taxonomy_ids = {
+        int(taxon) for taxon in
+        session.exec(select(ProductTaxonomy.taxonomy_id).where(ProductTaxonomy.product_id == prod.id))
+    }
 
-    return taxonomy_reponse(root, filter_ids=taxonomy_ids)
+    tree = taxonomy_cache.get(session)
+    return Response(tree.serialise(0, taxonomy_ids), media_type="application/json")
 
 @router.get("/scratch/{id}", response_model=ScratchpadResponse | None)
 async def get_scratchpad(
@@ -105,4 +153,27 @@ async def get_scratchpad(
     if not scratch:
         return None
 
-    return scratchpad_response(scratch)
+    collated = get_collated(session, [ item.product_id for item in scratch.items if item.product_id ])
+    return scratchpad_response(scratch, collated)
+
+# starts a solve in the background. poll /solve/{id}, or stream its progress
+# from /solve/{id}/events
+@router.post("/solve", response_model=SolveJobResponse)
+async def start_solve(request: SolveRequest):
+    job = await solve_queue.submit(request)
+    return job.response()
+
+@router.get("/solve/{id}", response_model=SolveJobResponse)
+async def get_solve(id: str):
+    return solve_queue.get(id).response()
+
+@router.get("/solve/{id}/events")
+async def stream_solve(id: str):
+    job = solve_queue.get(id)
+    return StreamingResponse(solve_queue.stream(job), media_type="text/event-stream")
+
+# a summary of everything the solver has reported since the server started:
+# phase timings, model sizes, backend node and iteration counts, cache hits
+@router.get("/metrics")
+async def get_metrics() -> dict[str, dict[str, float]]:
+    return metrics.to_dict()
@@ -0,0 +1,76 @@
+import json
+import os
+import sqlite3
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Any
+from src.metrics import instruments
+
+# a small on-disk cache of JSON values, kept in a single sqlite file. values are
+# stored zlib-compressed, and once there are more than max_entries the least
+# recently used ones are evicted
+@dataclass
+class DiskCache:
+    path: str
+    max_entries: int
+    hits: int
+    misses: int
+
+    def __init__(self, path: str = "data/solve_cache.db", max_entries: int = 1000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits, self.misses = 0, 0
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                used REAL NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS cache_used ON cache (used)")
+        self.conn.commit()
+
+    def get(self, key: str) -> Any | None:
+        row = self.conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+
+        if row is None:
+            self.misses += 1
+            instruments.emit("cache", hit=False)
+            return None
+
+        self.conn.execute("UPDATE cache SET used = ? WHERE key = ?", (time.time(), key))
+        self.conn.commit()
+        self.hits += 1
+        instruments.emit("cache", hit=True)
+
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, key: str, value: Any):
+        blob = zlib.compress(json.dumps(value, separators=(",", ":")).encode())
+
+        self.conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value, used) VALUES (?, ?, ?)",
+            (key, blob, time.time()),
+        )
+        self.conn.execute(
+            "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+        self.conn.commit()
+
+    def clear(self):
+        self.conn.execute("DELETE FROM cache")
+        self.conn.commit()
+
+# a stamp which changes whenever the catalogue database is written to. cheap
+# enough to check without opening the database
+def catalogue_version(path: str = "data/sainsbury.db") -> str:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return "missing"
+
+    return f"{st.st_size}-{st.st_mtime_ns}"
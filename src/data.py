@@ -1,7 +1,7 @@
 import re
 from typing import List, Optional
 from pydantic import BaseModel
-from sqlalchemy import Engine, Result, Sequence
+from sqlalchemy import JSON, Column, Engine, Float, Index, Result, Sequence, String, cast, delete, exists, insert, text
 from sqlalchemy.orm import aliased, selectinload
 from sqlmodel import Field, SQLModel, Session, Relationship, create_engine, select
 
@@ -24,7 +24,11 @@ class ProductNutrition(ProductNutritionBase, table=True):
 class ProductNutritionResponse(ProductNutritionBase):
     nutrition: "NutritionResponse"
 
+# indexed by taxon and then product, so the products under a taxon are read
+# from the index alone
 class ProductTaxonomy(SQLModel, table=True):
+    __table_args__ = (Index("ix_producttaxonomy_taxonomy_product", "taxonomy_id", "product_id"),)
+
     product_id: str = Field(foreign_key="product.id", primary_key=True)
     taxonomy_id: str = Field(foreign_key="taxonomy.id", primary_key=True)
 
@@ -39,11 +43,23 @@ class Taxonomy(TaxonomyBase, table=True):
     children: List["Taxonomy"] = Relationship(back_populates="parent")
     products: List["Product"] = Relationship(back_populates="taxonomies", link_model=ProductTaxonomy)
 
+# every (ancestor, descendant) pair of the taxonomy tree, including each taxon
+# with itself at depth 0, so a subtree or a breadcrumb is one indexed lookup
+# however deep the tree is. rebuilt by refresh_taxonomy_closure whenever
+# collate builds the tree from data/taxonomy.json
+class TaxonomyClosure(SQLModel, table=True):
+    ancestor_id: int = Field(foreign_key="taxonomy.id", primary_key=True)
+    descendant_id: int = Field(foreign_key="taxonomy.id", primary_key=True, index=True)
+    depth: int
+
 class TaxonomyResponse(TaxonomyBase):
     id: int
     parent_id: int | None
     parent_name: str | None = None
     children: List["TaxonomyResponse"]
+    # only in depth-limited responses (see get_taxon_info)
+    child_count: int | None = None
+    product_count: int | None = None
 
 class ProductBase(SQLModel):
     name: str
@@ -117,6 +133,17 @@ class Nutrition(NutritionBase, table=True):
     source: str
     products: List[ProductNutrition] = Relationship(back_populates="nutrition")
 
+# the nutrition of a product, collated as in get_nutr_val: each nutrient from
+# the surest ProductNutrition (of the right measure) which has it, per
+# unit_amount of the product. kept up to date by refresh_collated whenever
+# parse_html or matcher write ProductNutritions, so the API and the solver
+# read one row instead of going through every ProductNutrition
+class CollatedNutrition(NutritionBase, table=True):
+    product_id: str = Field(foreign_key="product.id", primary_key=True)
+
+    # the sureness of the source of each nutrient which has one
+    sureness: dict[str, float] = Field(default_factory=dict, sa_column=Column(JSON))
+
 class NutritionResponse(NutritionBase):
     name: str
     source: str
@@ -148,6 +175,13 @@ class ScratchpadResponse(ScratchpadBase):
 def get_engine(url: str = "sqlite:///data/sainsbury.db") -> Engine:
     engine = create_engine(url)
     SQLModel.metadata.create_all(engine)
+
+    # create_all only indexes new tables, so any index added to an existing
+    # one since is made here
+    with engine.begin() as connection:
+        for index in ProductTaxonomy.__table__.indexes: # type: ignore
+            index.create(connection, checkfirst=True)
+
     return engine
 
 def get_products(
@@ -157,21 +191,27 @@ def get_products(
     taxonomy_blacklist: list[int] = [],
     taxonomy_whitelist: list[int] = [],
     only_proper_measures: bool = False,
+    load_taxonomies: bool = False,
 ) -> list[Product]:
-    stmt = select(Product).where(
-        (Product.id.notin_(id_blacklist)) & ( # type: ignore
-            (Product.taxonomies.any(Taxonomy.id.in_(taxonomy_whitelist))) | # type: ignore
-            (~Product.taxonomies.any(Taxonomy.id.in_(taxonomy_blacklist))) # type: ignore
-        ))
+    stmt = select(Product).where(Product.id.notin_(id_blacklist)) # type: ignore
+
+    if taxonomy_blacklist:
+        ensure_taxonomy_closure(session)
+        stmt = stmt.where(
+            (Product.id.in_(products_under(taxonomy_whitelist))) | # type: ignore
+            (Product.id.notin_(products_under(taxonomy_blacklist))) # type: ignore
+        )
 
     if only_proper_measures:
         stmt = stmt.where(
             Product.nutritions.any(ProductNutrition.measure == Product.unit_measure) # type: ignore
         )
 
+    if load_all or load_taxonomies:
+        stmt = stmt.options(selectinload(Product.taxonomies)) # type: ignore
+
     if load_all:
         stmt = stmt.options(
-            selectinload(Product.taxonomies), # type: ignore
             selectinload(Product.nutritions).selectinload(ProductNutrition.nutrition) # type: ignore
         )
 
@@ -179,6 +219,121 @@ def get_products(
     assert prods is not None
     return list(prods) # type: ignore
 
+# rewrites the closure table from the parent of each taxon
+def refresh_taxonomy_closure(session: Session):
+    parents = { id: parent for id, parent in session.exec(select(Taxonomy.id, Taxonomy.parent_id)) }
+
+    # each taxon's ancestors, nearest first, starting with itself. worked out
+    # once per taxon, from its parent's, without recursing down the tree
+    ancestors: dict[int, list[int]] = {}
+    for id in parents:
+        path = []
+        node: int | None = id
+
+        while node is not None and node not in ancestors:
+            path.append(node)
+            node = parents.get(node)
+
+        above = ancestors[node] if node is not None else []
+        for n in reversed(path):
+            above = ancestors[n] = [ n ] + above
+
+    session.execute(delete(TaxonomyClosure))
+    rows = [
+        { "ancestor_id": a, "descendant_id": id, "depth": depth }
+        for id, line in ancestors.items()
+        for depth, a in enumerate(line)
+    ]
+    if rows:
+        session.execute(insert(TaxonomyClosure), rows)
+
+    session.commit()
+
+# fills in the closure table for a database from before it existed
+def ensure_taxonomy_closure(session: Session):
+    if session.exec(select(TaxonomyClosure.ancestor_id).limit(1)).first() is None\
+        and session.exec(select(Taxonomy.id).limit(1)).first() is not None:
+        refresh_taxonomy_closure(session)
+
+# the join from products' taxonomy links to the closure rows of their taxa.
+# producttaxonomy's taxonomy_id is text, so the closure's ids are cast to
+# match, or sqlite can't use its index and scans every link instead
+def linked_descendants():
+    return ProductTaxonomy.taxonomy_id == cast(TaxonomyClosure.descendant_id, String)
+
+# the ids of every product linked to any of taxa or anything under them
+def products_under(taxa: list[int]):
+    return select(ProductTaxonomy.product_id).join(TaxonomyClosure, linked_descendants()).where(TaxonomyClosure.ancestor_id.in_(taxa)) # type: ignore
+
+# whether a product is linked to any of taxa or anything under them, checked
+# a row at a time, for when only a few products are looked at (e.g. up to a
+# limit, or among search matches) rather than the whole catalogue
+def under_any(taxa: list[int]):
+    return exists().where(
+        ProductTaxonomy.product_id == Product.id,
+        linked_descendants(),
+        TaxonomyClosure.ancestor_id.in_(taxa), # type: ignore
+    )
+
+# the taxa from the root down to (and including) the given one
+def taxonomy_breadcrumb(session: Session, id: int) -> list[Taxonomy]:
+    ensure_taxonomy_closure(session)
+
+    return list(session.exec(
+        select(Taxonomy).join(TaxonomyClosure, TaxonomyClosure.ancestor_id == Taxonomy.id) # type: ignore
+        .where(TaxonomyClosure.descendant_id == id)
+        .order_by(TaxonomyClosure.depth.desc()) # type: ignore
+    ))
+
+# full-text search over the name, brand and description of every product: an
+# fts5 table, with prefix indexes so that search-as-you-type's partial last
+# word is cheap. it has its own copy of the text, keyed by product id, since
+# product's rowids aren't stable. rebuilt by refresh_product_search whenever
+# collate adds products
+PRODUCT_SEARCH_TABLE = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS productsearch USING fts5(
+        id UNINDEXED, name, brand, description,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '1 2 3'
+    )
+"""
+
+def refresh_product_search(session: Session):
+    session.execute(text(PRODUCT_SEARCH_TABLE))
+    session.execute(text("DELETE FROM productsearch"))
+
+    # in order of id, which is then the order of equally good matches
+    session.execute(text("""
+        INSERT INTO productsearch (id, name, brand, description)
+        SELECT id, name, coalesce(brand, ''), description FROM product ORDER BY id
+    """))
+
+    # the rank column is bm25, with a match in the name counting for most,
+    # then the brand, then the description
+    session.execute(text("INSERT INTO productsearch (productsearch, rank) VALUES ('rank', 'bm25(0.0, 10.0, 2.0, 1.0)')"))
+    session.execute(text("INSERT INTO productsearch (productsearch) VALUES ('optimize')"))
+    session.commit()
+
+# builds the search index for a database from before it existed
+def ensure_product_search(session: Session):
+    if session.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'productsearch'")).first() is None:
+        refresh_product_search(session)
+
+# an fts5 query matching every word of a search, each as a prefix (so
+# "chick tikk" finds "Chicken Tikka"), or None if it has no words at all
+def search_query(search: str) -> str | None:
+    return " ".join(f'"{word}"*' for word in re.findall(r"\w+", search)) or None
+
+# the id and rank (lower is better) of each product matching an fts5 query,
+# best first. ordering by fts5's own rank column lets sqlite read the matches
+# in order straight from the index, so joins and filters on them stop at the
+# limit rather than being run for every match and sorted afterwards
+def search_matches(query: str):
+    return text("""
+        SELECT id, rank FROM productsearch
+        WHERE productsearch MATCH :query ORDER BY rank
+    """).bindparams(query=query).columns(id=String, rank=Float).subquery("matches")
+
 # gets the nutrient value of a given nutrient n
 # per unit_amount of the product. 0 if not exist
 def get_nutr_val(product: Product, n: str) -> tuple[float, str, float]:
@@ -200,55 +355,98 @@ def get_nutr_val(product: Product, n: str) -> tuple[float, str, float]:
 
     return (0.0, "no source", 0.0)
 
-def collate_nutrition(product: Product) -> ProductResponse:
-    collated = NutritionResponse(
+# the collated nutrition of a product, worked out from its ProductNutritions.
+# the same as calling get_nutr_val for each nutrient, but in one pass
+def collate(product: Product) -> CollatedNutrition:
+    values, sureness = {}, {}
+
+    for pn in sorted(product.nutritions, key=lambda p: p.sureness, reverse=True):
+        if pn.measure != product.unit_measure or pn.sureness < 0.7:
+            continue
+
+        scale = pn.scale * product.unit_amount / pn.amount
+
+        for n in NutritionBase.model_fields:
+            if n not in values and isinstance(v := getattr(pn.nutrition, n), float):
+                values[n] = v * scale
+                sureness[n] = pn.sureness
+
+    return CollatedNutrition(product_id=product.id, sureness=sureness, **values)
+
+# rewrites the collated nutrition of the given products, or of every product.
+# products without any ProductNutritions don't get a row
+def refresh_collated(session: Session, product_ids: list[str] | None = None, chunk: int = 500):
+    if product_ids is None:
+        session.execute(delete(CollatedNutrition))
+        chunks = [ None ]
+    else:
+        ids = sorted(set(product_ids))
+        chunks = [ ids[i:i + chunk] for i in range(0, len(ids), chunk) ]
+
+    for ids in chunks:
+        stmt = select(Product).where(Product.nutritions.any()).options( # type: ignore
+            selectinload(Product.nutritions).selectinload(ProductNutrition.nutrition) # type: ignore
+        )
+
+        if ids is not None:
+            session.execute(delete(CollatedNutrition).where(CollatedNutrition.product_id.in_(ids))) # type: ignore
+            stmt = stmt.where(Product.id.in_(ids)) # type: ignore
+
+        for product in session.exec(stmt):
+            session.add(collate(product))
+
+        session.commit()
+
+# the collated nutrition of the given products, or of every product, by
+# product id. a database from before the table existed has it filled in first
+def get_collated(session: Session, product_ids: list[str] | None = None) -> dict[str, CollatedNutrition]:
+    if session.exec(select(CollatedNutrition.product_id).limit(1)).first() is None\
+        and session.exec(select(ProductNutrition.id).limit(1)).first() is not None:
+        refresh_collated(session)
+
+    stmt = select(CollatedNutrition)
+    if product_ids is not None:
+        stmt = stmt.where(CollatedNutrition.product_id.in_(product_ids)) # type: ignore
+
+    return { c.product_id: c for c in session.exec(stmt) }
+
+# the collated nutrition of a product as a response, from its row in the
+# collated table if it's been given, or else worked out from scratch
+def nutrition_response(product: Product, collated: CollatedNutrition | None = None) -> NutritionResponse:
+    collated = collated or collate(product)
+
+    return NutritionResponse(
         name=product.name,
-        source="total, collated"
+        source="total, collated",
+        **{ n: getattr(collated, n) for n in collated.sureness },
     )
 
-    for k in collated.__dict__.keys():
-        v, source, sureness = get_nutr_val(product, k)
-        if sureness > 0:
-            collated.__dict__[k] = v
-
+def collate_nutrition(product: Product, collated: CollatedNutrition | None = None) -> ProductResponse:
     resp = ProductResponse.model_validate(
         product,
-        update={"total_nutrition": collated}
+        update={"total_nutrition": nutrition_response(product, collated)}
     )
 
     return resp
 
-def taxonomy_reponse(
-    root: Taxonomy,
-    filter_ids: list[int] | None = None
-) -> TaxonomyResponse | None:
-    if filter_ids is not None and root.id not in filter_ids:
-        return None
-
-    child_responses = [
-        response for child in root.children
-        if (response := taxonomy_reponse(child, filter_ids)) is not None
-    ]
-
-    return TaxonomyResponse.from_orm(
-        root,
-        update={
-            "parent_name": root.parent.name if root.parent else None,
-            "children": child_responses,
-        }
-    )
-
-def scratchpad_response(scratch: Scratchpad) -> ScratchpadResponse:
+# collated is the collated nutrition of (at least) the scratchpad's products,
+# as from get_collated; any missing are worked out from scratch
+def scratchpad_response(scratch: Scratchpad, collated: dict[str, CollatedNutrition] = {}) -> ScratchpadResponse:
     items = []
 
     for item in scratch.items:
         if not item.product:
             continue
 
+        product = ShortProductResponse.model_validate(
+            item.product,
+            update={"total_nutrition": nutrition_response(item.product, collated.get(item.product.id))}
+        )
+
         items.append(ScratchpadItemResponse.from_orm(
             item,
             update={
-                "product": collate_nutrition(item.product)
+                "product": product
             }
         ))
 
@@ -0,0 +1,320 @@
+import asyncio
+import json
+import math
+import multiprocessing
+import queue
+import re
+import threading
+import time
+import uuid
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator
+from fastapi import HTTPException
+from pydantic import field_validator
+from sqlalchemy import Engine
+from sqlmodel import SQLModel
+from src.cache import DiskCache, catalogue_version
+from src.matrix import NUTRIENTS
+from src.metrics import Event, instruments
+from src.problem import Model, Problem, Target, solve_highs, target, taxonomy_blacklist, taxonomy_whitelist
+
+class SolveRequest(SQLModel):
+    # each key is a nutrient, or "taxon:NNN" for the amount from a taxon
+    target: dict[str, tuple[float | None, float | None]]
+    banned_ids: list[str] = []
+    # the solver's defaults, if not given
+    taxonomy_whitelist: list[int] | None = None
+    taxonomy_blacklist: list[int] | None = None
+    # product id -> (min, max) units
+    bounds: dict[str, tuple[float | None, float | None]] = {}
+    # stop early, with the best recipe found, after time_limit seconds or once
+    # within gap (relative) of optimal
+    time_limit: float | None = None
+    gap: float | None = None
+
+    @field_validator("target")
+    @classmethod
+    def known_keys(cls, target: Target) -> Target:
+        if unknown := [ k for k in target if k not in NUTRIENTS and not re.fullmatch(r"taxon:\d+", k) ]:
+            raise ValueError(f"unknown target keys: {', '.join(unknown)}")
+
+        return target
+
+class SolveJobResponse(SQLModel):
+    id: str
+    status: str
+    error: str | None = None
+    result: dict[str, Any] | None = None
+    queued_for: float | None = None
+    solved_in: float | None = None
+
+@dataclass
+class Job:
+    id: str
+    request: SolveRequest
+    status: str = "queued"
+    error: str | None = None
+    result: dict[str, Any] | None = None
+
+    created: float = field(default_factory=time.perf_counter)
+    started: float | None = None
+    finished: float | None = None
+
+    # every status change, in order, for anything streaming the job. changed
+    # is replaced (and the old one set) on each update
+    events: list[dict[str, Any]] = field(default_factory=list)
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in ["done", "failed"]
+
+    def update(self, status: str, **data):
+        self.status = status
+
+        if status == "running":
+            self.started = time.perf_counter()
+        elif status in ["done", "failed"]:
+            self.finished = time.perf_counter()
+
+        self.events.append({ "status": status, **data })
+
+        if self.is_finished:
+            response = self.response()
+            instruments.emit(
+                "job",
+                status=status,
+                cached=bool(data.get("cached", False)),
+                queued_for=response.queued_for,
+                solved_in=response.solved_in,
+            )
+
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    def response(self) -> SolveJobResponse:
+        started = self.started or self.finished
+
+        return SolveJobResponse(
+            id=self.id,
+            status=self.status,
+            error=self.error,
+            result=self.result,
+            queued_for=started - self.created if started else None,
+            solved_in=self.finished - started if self.finished and started else None,
+        )
+
+# runs in the pool: solves the model, putting each improving recipe found on
+# incumbents as it goes, and then None. the solver's events are handed back
+# with the result, to be sent on from the server's process
+def solve_streaming(
+    model: Model,
+    time_limit: float | None,
+    gap: float | None,
+    incumbents: queue.Queue,
+) -> tuple[tuple[np.ndarray, bool] | None, list[Event]]:
+    try:
+        with instruments.capture() as events:
+            result = solve_highs(
+                model,
+                time_limit=time_limit,
+                gap=gap,
+                on_incumbent=lambda x, gap: incumbents.put((x, gap)),
+            )
+
+        return result, events
+    finally:
+        incumbents.put(None)
+
+# runs solves in the background, so they never block request handling. one
+# Problem is loaded (on the first solve) and kept in memory; each job borrows
+# it briefly, in a thread, to build its model, and the model is then solved in
+# a bounded pool of processes
+class SolveQueue:
+    def __init__(
+        self,
+        engine: Engine,
+        workers: int = 2,
+        max_pending: int = 32,
+        max_jobs: int = 1000,
+    ):
+        self.engine = engine
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_jobs = max_jobs
+
+        self.jobs: dict[str, Job] = {}
+        self.tasks: set[asyncio.Task] = set()
+
+        self.problem: Problem | None = None
+        self.problem_lock = threading.Lock()
+        self.load_lock: asyncio.Lock | None = None
+        self.pool: ProcessPoolExecutor | None = None
+        self.manager: Any = None
+        self.cache = DiskCache()
+
+    def get(self, id: str) -> Job:
+        if (job := self.jobs.get(id)) is None:
+            raise HTTPException(status_code=404, detail="No such job.")
+
+        return job
+
+    async def submit(self, request: SolveRequest) -> Job:
+        pending = sum(1 for job in self.jobs.values() if not job.is_finished)
+        if pending >= self.max_pending:
+            raise HTTPException(status_code=503, detail="Too many solves queued, try again later.")
+
+        job = Job(id=uuid.uuid4().hex, request=request)
+        self.jobs[job.id] = job
+        self.evict()
+
+        task = asyncio.create_task(self.run(job))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+        return job
+
+    # forgets the oldest finished jobs, past max_jobs
+    def evict(self):
+        excess = len(self.jobs) - self.max_jobs
+        for id in [ id for id, job in self.jobs.items() if job.is_finished ][:max(0, excess)]:
+            del self.jobs[id]
+
+    async def load_problem(self) -> Problem:
+        if self.load_lock is None:
+            self.load_lock = asyncio.Lock()
+
+        async with self.load_lock:
+            if self.problem is None:
+                problem = await asyncio.to_thread(Problem.load, dict(target), self.engine)
+
+                # the server has threads running by now, which a forked
+                # process could deadlock on, so workers are spawned afresh
+                context = multiprocessing.get_context("spawn")
+                pool = ProcessPoolExecutor(self.workers, mp_context=context)
+                try:
+                    manager = context.Manager()
+                except Exception:
+                    pool.shutdown()
+                    raise
+
+                # only kept once everything is up, so a failure is tried
+                # again from scratch by the next job
+                self.pool, self.manager, self.problem = pool, manager, problem
+
+        return self.problem
+
+    # sets the shared problem up for a request, returning its model and cache
+    # key. runs in a thread
+    def prepare(self, request: SolveRequest) -> tuple[Model, str, Target]:
+        problem = self.problem
+        assert problem is not None
+
+        with self.problem_lock:
+            target = dict(request.target)
+            problem.set_target(target)
+
+            problem.banned_ids = list(request.banned_ids)
+            problem.taxonomy_whitelist = list(taxonomy_whitelist if request.taxonomy_whitelist is None else request.taxonomy_whitelist)
+            problem.taxonomy_blacklist = list(taxonomy_blacklist if request.taxonomy_blacklist is None else request.taxonomy_blacklist)
+            problem.reapply_filter()
+
+            problem.all_bounds[:] = np.nan
+            for id, (mn, mx) in request.bounds.items():
+                if id in problem.index:
+                    problem.set_bounds(id, mn, mx)
+
+            key = problem.cache_key(catalogue_version(self.engine.url.database or ""))
+            model = problem.model()
+            problem.all_bounds[:] = np.nan
+
+        return model, key, target
+
+    async def run(self, job: Job):
+        try:
+            problem = await self.load_problem()
+            model, key, target = await asyncio.to_thread(self.prepare, job.request)
+
+            if (cached := self.cache.get(key)) is not None:
+                job.result = cached
+                job.update("done", cached=True)
+                return
+
+            job.update("running", products=len(model.cols))
+
+            if len(model.cols) == 0:
+                result = None
+            else:
+                incumbents = self.manager.Queue()
+                loop = asyncio.get_running_loop()
+                solving = loop.run_in_executor(
+                    self.pool, solve_streaming,
+                    model, job.request.time_limit, job.request.gap, incumbents,
+                )
+
+                # each better recipe is sent out as it's found, and is what
+                # the job gives until the solve is over
+                while (item := await self.next_incumbent(incumbents, solving)) is not None:
+                    x, gap = item
+                    solution = await asyncio.to_thread(problem.make_model_recipe, model, x, target, False)
+                    job.result = solution.to_dict()
+                    job.update(
+                        "incumbent",
+                        total_price=solution.total_price,
+                        gap=gap if math.isfinite(gap) else None,
+                        solution=job.result,
+                    )
+
+                result, events = await solving
+                for event in events:
+                    instruments.send(event)
+
+            if result is None:
+                job.result = None
+                job.error = "no solution"
+                job.update("failed", error=job.error)
+                return
+
+            solution = await asyncio.to_thread(problem.make_model_recipe, model, result[0], target)
+            job.result = solution.to_dict()
+
+            # a recipe cut short by the budget might not be the cheapest, and
+            # nor might one highs calls optimal once it's within a looser gap.
+            # the cache key has neither, so only the cheapest recipe is kept
+            if result[1] and job.request.gap is None:
+                self.cache.put(key, job.result)
+
+            job.update("done", optimal=result[1])
+        except Exception as e:
+            job.error = str(e)
+            job.update("failed", error=job.error)
+
+    # the next incumbent from a solve, or None once it's over
+    async def next_incumbent(self, incumbents: queue.Queue, solving: asyncio.Future) -> Any:
+        while True:
+            try:
+                return await asyncio.to_thread(incumbents.get, timeout=0.1)
+            except queue.Empty:
+                # the solve never started, so nothing will come
+                if solving.done() and solving.exception() is not None:
+                    return None
+
+    # server-sent events for each status change of a job, until it finishes
+    async def stream(self, job: Job) -> AsyncIterator[str]:
+        sent = 0
+
+        while True:
+            changed = job.changed
+
+            for event in job.events[sent:]:
+                yield f"event: {event['status']}\ndata: {json.dumps(event)}\n\n"
+            sent = len(job.events)
+
+            if job.is_finished:
+                if job.result is not None:
+                    yield f"event: result\ndata: {json.dumps(job.result)}\n\n"
+                return
+
+            await changed.wait()
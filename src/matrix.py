@@ -0,0 +1,219 @@
+import re
+import numpy as np
+from scipy import sparse
+from dataclasses import dataclass
+from typing import Mapping
+from src.data import CollatedNutrition, NutritionBase, Product
+
+NUTRIENTS: list[str] = list(NutritionBase.model_fields.keys())
+NUTRIENT_INDEX: dict[str, int] = { k: i for i, k in enumerate(NUTRIENTS) }
+
+# the collated nutrition of a list of products, as a dense products x nutrients
+# array. each value matches get_nutr_val: it's the amount per unit_amount of the
+# product, taken from the surest ProductNutrition (of the right measure) which
+# actually has that nutrient. sureness is 0 wherever there was no source.
+#
+# taxonomy membership is kept as a bitset per product: each taxon is given a
+# bit (taxa[b] is the taxon of bit b), and row i of taxon_bits, in 64-bit words,
+# has the bits of every taxon product i is in. collate links products to each
+# taxon above them too, so that's the product's whole ancestry, and "is this
+# product under any of these taxa" is an AND over the whole catalogue at once
+@dataclass
+class NutrientMatrix:
+    values: np.ndarray
+    sureness: np.ndarray
+    unit_amounts: np.ndarray
+    taxa: np.ndarray
+    taxon_bits: np.ndarray
+    taxon_index: dict[int, int]
+    taxon_columns: dict[int, np.ndarray]
+
+    def __init__(self, products: list[Product]):
+        n, k = len(products), len(NUTRIENTS)
+
+        self.values = np.zeros((n, k))
+        self.sureness = np.zeros((n, k))
+        self.unit_amounts = np.array([ p.unit_amount for p in products ], dtype=float)
+        self.set_taxa(*taxon_bitsets([ { t.id for t in p.taxonomies } for p in products ]))
+
+        # one pass over every usable product-nutrition pairing. rows for the
+        # same product are contiguous and in order of decreasing sureness, so
+        # the first row with a value is the one get_nutr_val would pick
+        rows, owners, scales, sures = [], [], [], []
+        nutrition_rows: dict[int, list[float]] = {}
+
+        for i, product in enumerate(products):
+            for pn in sorted(product.nutritions, key=lambda p: p.sureness, reverse=True):
+                if pn.measure != product.unit_measure or pn.sureness < 0.7:
+                    continue
+
+                nutr = pn.nutrition
+                assert nutr is not None
+
+                if (row := nutrition_rows.get(id(nutr))) is None:
+                    row = [
+                        v if isinstance(v := getattr(nutr, k), float) else np.nan
+                        for k in NUTRIENTS
+                    ]
+                    nutrition_rows[id(nutr)] = row
+
+                rows.append(row)
+                owners.append(i)
+                scales.append(pn.scale * product.unit_amount / pn.amount)
+                sures.append(pn.sureness)
+
+        if len(rows) == 0:
+            return
+
+        entries = np.array(rows, dtype=float)
+        owner = np.array(owners)
+        scale = np.array(scales)
+        sure = np.array(sures)
+
+        for j in range(k):
+            present = np.flatnonzero(~np.isnan(entries[:, j]))
+            prods, first = np.unique(owner[present], return_index=True)
+            picked = present[first]
+
+            self.values[prods, j] = entries[picked, j] * scale[picked]
+            self.sureness[prods, j] = sure[picked]
+
+    # the matrix of products from their rows in the collated nutrition table
+    # (see get_collated), so their ProductNutritions needn't be loaded at all.
+    # only their taxonomies are needed, and products without a row are all 0
+    @classmethod
+    def from_collated(cls, products: list[Product], collated: Mapping[str, CollatedNutrition]) -> "NutrientMatrix":
+        n, k = len(products), len(NUTRIENTS)
+
+        values = np.zeros((n, k))
+        sureness = np.zeros((n, k))
+
+        for i, product in enumerate(products):
+            if (row := collated.get(product.id)) is None:
+                continue
+
+            for nutrient, sure in row.sureness.items():
+                j = NUTRIENT_INDEX[nutrient]
+                values[i, j] = getattr(row, nutrient)
+                sureness[i, j] = sure
+
+        return cls.from_arrays(
+            values,
+            sureness,
+            np.array([ p.unit_amount for p in products ], dtype=float),
+            *taxon_bitsets([ { t.id for t in p.taxonomies } for p in products ]),
+        )
+
+    # rebuilds a matrix from its arrays, e.g. when they're shared with another
+    # process or read from a snapshot
+    @classmethod
+    def from_arrays(
+        cls,
+        values: np.ndarray,
+        sureness: np.ndarray,
+        unit_amounts: np.ndarray,
+        taxa: np.ndarray,
+        taxon_bits: np.ndarray,
+    ) -> "NutrientMatrix":
+        matrix = cls.__new__(cls)
+
+        matrix.values = values
+        matrix.sureness = sureness
+        matrix.unit_amounts = unit_amounts
+        matrix.set_taxa(taxa, taxon_bits)
+
+        return matrix
+
+    def set_taxa(self, taxa: np.ndarray, taxon_bits: np.ndarray):
+        self.taxa = taxa
+        self.taxon_bits = taxon_bits
+        self.taxon_index = { int(t): b for b, t in enumerate(taxa) }
+        self.taxon_columns = {}
+
+    def __len__(self) -> int:
+        return len(self.unit_amounts)
+
+    # the bitset with the bits of each of taxa which any product is in
+    def taxon_mask(self, taxa: list[int]) -> np.ndarray:
+        mask = np.zeros(self.taxon_bits.shape[1], dtype=np.uint64)
+
+        for t in taxa:
+            if (b := self.taxon_index.get(t)) is not None:
+                mask[b // 64] |= np.uint64(1) << np.uint64(b % 64)
+
+        return mask
+
+    # whether each product is in (or under) any of taxa
+    def in_any(self, taxa: list[int]) -> np.ndarray:
+        mask = self.taxon_mask(taxa)
+        words = np.flatnonzero(mask)
+
+        return (self.taxon_bits[:, words] & mask[words]).any(axis=1)
+
+    def taxon_column(self, taxon: int) -> np.ndarray:
+        if (col := self.taxon_columns.get(taxon)) is None:
+            col = self.taxon_columns[taxon] = np.where(self.in_any([taxon]), self.unit_amounts, 0.0)
+
+        return col
+
+    # the values of key (a nutrient, or "taxon:NNN") for every product
+    def column(self, key: str) -> np.ndarray:
+        if m := re.match(r"taxon:(\d+)", key):
+            return self.taxon_column(int(m.group(1)))
+
+        return self.values[:, NUTRIENT_INDEX[key]]
+
+    # the values of each key as a products x keys array, for all products or
+    # just the given ones
+    def columns(self, keys: list[str], products: np.ndarray | None = None) -> np.ndarray:
+        rows = slice(None) if products is None else products
+        out = np.empty((len(self) if products is None else len(products), len(keys)))
+
+        for j, key in enumerate(keys):
+            out[:, j] = self.column(key)[rows]
+
+        return out
+
+    # the values of each key as a sparse keys x products matrix, with row i
+    # multiplied by signs[i]. only the non-zeros are ever copied
+    def sparse_rows(self, keys: list[str], signs: list[float]) -> sparse.csr_matrix:
+        indptr, indices, data = [0], [], []
+
+        for key, sign in zip(keys, signs):
+            col = self.column(key)
+            nonzero = np.flatnonzero(col)
+
+            indptr.append(indptr[-1] + len(nonzero))
+            indices.append(nonzero)
+            data.append(col[nonzero] * sign)
+
+        return sparse.csr_matrix(
+            (
+                np.concatenate(data) if data else np.zeros(0),
+                np.concatenate(indices) if indices else np.zeros(0, dtype=int),
+                np.array(indptr),
+            ),
+            shape=(len(keys), len(self)),
+        )
+
+    # whether each product has any source for nutrient n
+    def known(self, n: str) -> np.ndarray:
+        return self.sureness[:, NUTRIENT_INDEX[n]] > 0
+
+# the bitsets of a list of per-product taxa: the taxon of each bit, in order,
+# and a products x words array of bits
+def taxon_bitsets(taxonomies: list[set[int]]) -> tuple[np.ndarray, np.ndarray]:
+    taxa = np.array(sorted(set().union(*taxonomies)), dtype=np.int64)
+    index = { int(t): b for b, t in enumerate(taxa) }
+
+    rows, bits = [], []
+    for i, ts in enumerate(taxonomies):
+        for t in ts:
+            rows.append(i)
+            bits.append(index[t])
+
+    rows, bits = np.array(rows, dtype=np.int64), np.array(bits, dtype=np.int64)
+    words = np.zeros((len(taxonomies), (len(taxa) + 63) // 64), dtype=np.uint64)
+    np.bitwise_or.at(words, (rows, bits // 64), np.left_shift(np.uint64(1), (bits % 64).astype(np.uint64)))
+
+    return taxa, words
@@ -0,0 +1,141 @@
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterator, TextIO
+
+Event = dict[str, Any]
+Sink = Callable[[Event], None]
+
+# where the solver reports what it's doing. every event is a flat dict, like
+#
+#     {"event": "solve", "time": 1760000000.0, "seconds": 0.41,
+#      "backend": "highs", "status": "optimal", "nodes": 12, "iterations": 830}
+#
+# and goes to each sink: a JsonLines stream, a Metrics registry, or anything
+# else which takes a dict. with no sinks, nothing is built or written
+@dataclass
+class Instruments:
+    sinks: list[Sink] = field(default_factory=list)
+
+    def emit(self, event: str, **fields: Any):
+        if not self.sinks:
+            return
+
+        self.send({ "event": event, "time": time.time(), **fields })
+
+    def send(self, event: Event):
+        for sink in self.sinks:
+            sink(event)
+
+    # times the body, then emits the event with its seconds. anything the
+    # body puts in the yielded dict is sent along too. a body which raises
+    # still emits, with the exception's type as error
+    @contextmanager
+    def phase(self, event: str, **fields: Any) -> Iterator[dict[str, Any]]:
+        start = time.perf_counter()
+        fields = dict(fields)
+
+        try:
+            yield fields
+        except Exception as e:
+            fields["error"] = type(e).__name__
+            raise
+        finally:
+            self.emit(event, seconds=time.perf_counter() - start, **fields)
+
+    # gathers the events emitted in the body, instead of sending them, e.g. so
+    # a worker process can hand them back to be sent from the parent
+    @contextmanager
+    def capture(self) -> Iterator[list[Event]]:
+        captured: list[Event] = []
+        sinks, self.sinks = self.sinks, [ captured.append ]
+
+        try:
+            yield captured
+        finally:
+            self.sinks = sinks
+
+# writes each event as a line of json
+class JsonLines:
+    def __init__(self, stream: TextIO):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def __call__(self, event: Event):
+        line = json.dumps(event, separators=(",", ":"), default=str)
+        with self.lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+
+@dataclass
+class Summary:
+    count: int = 0
+    total: float = 0.0
+    min: float = float("inf")
+    max: float = float("-inf")
+
+    def add(self, value: float):
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def to_dict(self) -> dict[str, float]:
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "min": self.min,
+            "max": self.max,
+        }
+
+# an in-process registry summing up events. each number (or flag, as 0 or 1)
+# in an event is summarised under "<event>.<field>", labelled with the
+# event's text fields, e.g. "solve.seconds{backend=highs,status=optimal}"
+@dataclass
+class Metrics:
+    summaries: dict[str, Summary] = field(default_factory=dict)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def __call__(self, event: Event):
+        labels = ",".join(
+            f"{k}={v}" for k, v in sorted(event.items())
+            if isinstance(v, str) and k != "event"
+        )
+        suffix = f"{{{labels}}}" if labels else ""
+
+        with self.lock:
+            for k, v in event.items():
+                if k == "time" or not isinstance(v, (int, float)):
+                    continue
+
+                name = f"{event['event']}.{k}{suffix}"
+                if (summary := self.summaries.get(name)) is None:
+                    summary = self.summaries[name] = Summary()
+                summary.add(float(v))
+
+    def to_dict(self) -> dict[str, dict[str, float]]:
+        with self.lock:
+            return { name: s.to_dict() for name, s in sorted(self.summaries.items()) }
+
+    def clear(self):
+        with self.lock:
+            self.summaries.clear()
+
+instruments = Instruments()
+
+# SOLVER_EVENTS turns on json events from the start: "-" for stderr, or a file
+# to append them to
+if (path := os.environ.get("SOLVER_EVENTS")):
+    if path == "-":
+        stream = sys.stderr
+    else:
+        stream = open(path, "a")
+        atexit.register(stream.close)
+
+    instruments.sinks.append(JsonLines(stream))
@@ -0,0 +1,131 @@
+import numpy as np
+from scipy import sparse
+
+# dominance presolve for the semi-continuous diet problem:
+#
+#   min c.x  s.t.  A x <= b,  x_j = 0 or lower_j <= x_j <= upper_j
+#
+# everything is compared per unit of amount (x_j * scales_j, e.g. grams), so
+# the same product sold in different pack sizes lines up. column k dominates
+# column j if, per amount, k is no more expensive and no worse in any row, and
+# k's [lower, upper] window contains j's. given an optimal solution using j:
+#
+#  a) if some dominator is unused, all of j can be moved onto it
+#  b) if the dominators have enough room left between them, j can be spread
+#     over them
+#  c) otherwise every dominator is used, and nearly full. if that would break
+#     some row whose coefficients are all non-negative (a maximum, like energy
+#     or "at most 200g of bread") then this case can't happen
+#
+# moving amount from j to a dominator never raises the cost or any row, so if
+# (c) is impossible there's always an optimal solution without j, and j can be
+# dropped. dominators are only ever columns which are kept, so dropping many
+# columns at once is just as safe as dropping one.
+
+# which columns can be dropped without changing the optimum. columns with an
+# upper bound of 0 are taken to be inactive, and are never dropped or used as
+# dominators. exact_rows are rows which dominance forces to be equal (both
+# bounds of a nutrient), used to bucket columns so as not to compare every
+# pair; at most max_dominators are checked against each column
+def dominated_columns(
+    amounts: sparse.csr_matrix,
+    goals: np.ndarray,
+    prices: np.ndarray,
+    lower: np.ndarray,
+    upper: np.ndarray,
+    scales: np.ndarray,
+    exact_rows: list[int] = [],
+    max_dominators: int = 1024,
+    tol: float = 1e-9,
+) -> np.ndarray:
+    n = amounts.shape[1]
+    dropped = np.zeros(n, dtype=bool)
+
+    active = np.flatnonzero(upper > 0)
+    if len(active) < 2:
+        return dropped
+
+    # rows where nothing can have a negative contribution
+    max_rows = np.flatnonzero(amounts.min(axis=1).toarray().ravel() >= 0)
+
+    per_amount = sparse.diags(1 / scales[active])
+    coeffs = (amounts[:, active] @ per_amount).tocsc()
+    cost = prices[active] / scales[active]
+    low = lower[active] * scales[active]
+    high = upper[active] * scales[active]
+
+    buckets: dict[bytes, list[int]] = {}
+    exact = coeffs[exact_rows, :].toarray().astype(np.float32)
+    for i in range(len(active)):
+        buckets.setdefault(exact[:, i].tobytes(), []).append(i)
+
+    # only columns sharing a bucket can dominate each other, so only those
+    # need their coefficients written out in full
+    shared = [ b for b in buckets.values() if len(b) > 1 ]
+    if len(shared) == 0:
+        return dropped
+
+    flat = np.concatenate(shared)
+    all_dense = coeffs[:, flat].toarray()
+    starts = np.cumsum([0] + [ len(b) for b in shared ])
+
+    for bucket, start in zip(shared, starts):
+        cols = np.array(bucket)
+        dense = all_dense[:, start:start + len(cols)]
+
+        # anything which dominates a column sorts before it
+        order = np.lexsort((cols, dense.sum(axis=0), cost[cols]))
+        kept = np.empty(len(cols), dtype=int)
+        num_kept = 0
+
+        for j in order:
+            if num_kept > 0:
+                cand = kept[:min(num_kept, max_dominators)]
+                slack = tol * np.maximum(np.abs(dense[:, cand]), np.abs(dense[:, [j]]))
+
+                dominates = (dense[:, cand] <= dense[:, [j]] + slack).all(axis=0)\
+                    & (cost[cols[cand]] <= cost[cols[j]] * (1 + tol))\
+                    & (low[cols[cand]] <= low[cols[j]])\
+                    & (high[cols[cand]] >= high[cols[j]])
+
+                doms = cand[dominates]
+                if len(doms) > 0 and full_dominators_infeasible(
+                    dense[:, doms], dense[:, j], goals, max_rows,
+                    low[cols[doms]], high[cols[doms]], low[cols[j]], tol
+                ):
+                    dropped[active[cols[j]]] = True
+                    continue
+
+            kept[num_kept] = j
+            num_kept += 1
+
+    return dropped
+
+# case (c): whether every dominator being used, with less than low_j room left
+# between them, must break one of the max rows. for a row r, the least it can
+# be is when the dominators are all full except for low_j taken away from
+# those with the largest coefficients, plus low_j of column j
+def full_dominators_infeasible(
+    doms: np.ndarray,
+    col: np.ndarray,
+    goals: np.ndarray,
+    max_rows: np.ndarray,
+    low: np.ndarray,
+    high: np.ndarray,
+    low_j: float,
+    tol: float,
+) -> bool:
+    if len(max_rows) == 0:
+        return False
+
+    coeffs = doms[max_rows]
+    order = np.argsort(-coeffs, axis=1)
+    room = (high - low)[order]
+    take = np.clip(low_j - (np.cumsum(room, axis=1) - room), 0, room)
+
+    least = coeffs @ high\
+        - (np.take_along_axis(coeffs, order, axis=1) * take).sum(axis=1)\
+        + col[max_rows] * low_j
+
+    bounds = goals[max_rows]
+    return bool((least > bounds + tol * np.maximum(1.0, np.abs(bounds))).any())
@@ -0,0 +1,993 @@
+from dataclasses import dataclass
+from typing import Any, Callable, Iterator, Sequence
+from scipy import sparse
+from src.data import *
+from src.cache import catalogue_version
+from src.matrix import NutrientMatrix
+from src.metrics import instruments
+from src.presolve import dominated_columns
+from src.products import ProductRecord, ProductTable
+from src.snapshot import Snapshot
+
+import hashlib
+import highspy
+import json
+import numpy as np
+import os
+import queue
+import threading
+
+Target = dict[str, tuple[float | None, float | None]]
+
+target: Target = {
+    "energy": (2100, 2300),
+    # "protein": (85, None),
+    # "fat": (50, 75),
+    # "sat_fat": (None, 15),
+    # "carbohydrate": (280, 350),
+    # "total_sugar": (150, None),
+    "fibre": (30, None),
+    "sodium": (2400e-3, 3600e-3),
+
+    "potassium": (3500e-3, None),
+    "calcium": (1000e-3, None),
+    "magnesium": (350e-3, None),
+    # "chromium": (0, None),
+    # "molybdenum": (0, None),
+    "phosphorus": (550e-3, None),
+    "iron": (8.7e-3, None),
+    "copper": (1.4e-3, None),
+    "zinc": (9.5e-3, None),
+    # "manganese": (0e-3, None),
+    "selenium": (75e-6, None),
+    "iodine": (140e-6, None),
+
+    "vit_a": (700e-6, None),
+    "vit_c": (40e-3, None),
+    "vit_d": (10e-6, None),
+    "vit_e": (4e-3, None),
+    "vit_k": (75e-6, None),
+    "vit_b1": (1e-3, None),
+    "vit_b2": (1.3e-3, None),
+    "vit_b3": (16.5e-3, None),
+    "vit_b5": (5e-3, None),
+    "vit_b6": (1.4e-3, None),
+    # "vit_b7": (0e-6, None),
+    "vit_b9": (400e-6, None),
+    "vit_b12": (15e-6, None),
+}
+
+target: Target = {
+    "energy": (2100, 2300),
+    "protein": (85, None),
+    "fat": (50, None),
+    "sat_fat": (None, 15),
+    "carbohydrate": (280, None),
+    "total_sugar": (None, 35),
+    "fibre": (30, None),
+    "sodium": (2400e-3, 3600e-3),
+
+    "potassium": (3500e-3, None),
+    "calcium": (1000e-3, None),
+    "magnesium": (350e-3, None),
+    # "chromium": (0, None),
+    # "molybdenum": (0, None),
+    "phosphorus": (550e-3, None),
+    "iron": (8.7e-3, None),
+    "copper": (1.4e-3, None),
+    "zinc": (9.5e-3, None),
+    # "manganese": (0e-3, None),
+    "selenium": (75e-6, None),
+    "iodine": (140e-6, None),
+
+    "vit_a": (700e-6, None),
+    "vit_c": (40e-3, None),
+    "vit_d": (10e-6, None),
+    "vit_e": (4e-3, None),
+    "vit_k": (75e-6, None),
+    "vit_b1": (1e-3, None),
+    "vit_b2": (1.3e-3, None),
+    "vit_b3": (16.5e-3, None),
+    "vit_b5": (5e-3, None),
+    "vit_b6": (1.4e-3, None),
+    # "vit_b7": (0e-6, None),
+    "vit_b9": (400e-6, None),
+    "vit_b12": (15e-6, None),
+
+    # at least 500g of fruit & veg
+    "taxon:1020082": (750, None),
+
+    # at most 200g of bread
+    "taxon:1018785": (None, 200),
+
+    # at most 50g of "home baking"
+    "taxon:1019837": (None, 50),
+}
+
+# where Problem.load keeps its snapshot of the catalogue in the database at
+# database: beside it, named after it
+def snapshot_path(database: str = "data/sainsbury.db") -> str:
+    return os.path.splitext(database)[0] + ".npz"
+
+global_id_blacklist = [
+    "8092711", # Wrong price (beef)
+    "6567540", # Wrong price (noodles)
+    "7855654", # Wrong price (couscous)
+    "7863309", # Some chicken that's categorised as fruit & veg?
+    "7861621", # Some chicken that's categorised as fruit & veg?
+    "8105729", # Bitter gourd (sounds yucky)
+    "8168098", # Yoghurt with incorrect vit D
+    "8079236", # Cheestrings, incorrect B6
+    "8035841", # Beansprouts, out-of-date price
+    "7377250", # Party pretzels, incorrect sodium
+    "7518068", # Lime leaves, incorrect amount
+    "7518051", # Bay leaves, incorrect mapping
+]
+
+taxonomy_blacklist = [
+    0
+]
+
+taxonomy_whitelist = [
+    1018859, # Bakery
+    # Dairy, eggs & chilled
+      1019075, # Dairy & eggs
+      1019084, # Desserts
+      1019106, # Fruit juice & drinks
+      1019176, # Vegetarian, vegan & dairy free (chilled)
+    1019463, # Drinks
+    # Food cupboard
+      1019495, # Biscuits & crackers
+      # Canned ...
+        1019496, # Baked beans & canned pasta
+        1019510, # Canned fish
+        1019511, # Canned fruit
+        1019514, # Olives & antipasti
+        1019515, # Pickled food
+        1019516, # Pulses & beans
+        1019528, # Soups
+        1019530, # Tomatoes
+        1019538, # Vegetables
+        1019539, # Vegetarian
+      1019573, # Cereals
+      1019598, # Confectionary
+      1019630, # Cooking ingredients & oils
+      1019666, # Cooking sauces & meal kits
+      1019694, # Crisps, nuts & snacking fruit
+      1019744, # Fruit & desserts
+      1019754, # Jams, honey & spreads
+      1019794, # Rice, pasta & noodles
+      # 1019837, # Sugar & home baking
+      1019850, # Table sauces etc
+      1019869, # Tea, coffee & hot drinks
+    # Frozen
+      1019895, # Chips, potatoes & rice
+      1019902, # Desserts & pastry
+      1019924, # Fish & seafood
+      1019934, # Fruit, veg & herbs
+      1019943, # Ice cream & ice
+      1019974, # Pizza & garlic bread
+      1019988, # Vegan
+      1019999, # Vegetarian & meat free
+      1020000, # Yorkshires & roast accompaniments
+    1020082, # Fruit & veg
+    # Meat & fish
+      1020363, # Fish & seafood
+      1020378, # Meat free
+]
+
+min_to_use = {
+    "g": 50,
+    "ml": 50,
+    "serving": 0.5,
+}
+
+max_to_use = {
+    "g": 500,
+    "ml": 500,
+    "serving": 5,
+}
+
+# protein, carbohydrate and fat are always needed, to work out the energy
+required_nutrients = ["protein", "carbohydrate", "fat"]
+
+# the constraint rows for a target: a key and sign for each, saying which
+# column of the nutrient matrix it is (negated, for minimums), and its bound
+def target_rows(target: Target) -> tuple[list[str], list[float], list[float]]:
+    keys, signs, goals = [], [], []
+
+    for k, (mn, mx) in target.items():
+        if mn != None:
+            keys.append(k)
+            signs.append(-1.0)
+            goals.append(-mn)
+        if mx != None:
+            keys.append(k)
+            signs.append(1.0)
+            goals.append(mx)
+
+    return keys, signs, goals
+
+@dataclass
+class Solution:
+    recipe: list[tuple[ProductRecord, float]]
+    keys: list[str]
+    # contributions[i, j] is how much of keys[j] the i-th item of the recipe
+    # gives, and item_prices[i] what it costs
+    contributions: np.ndarray
+    item_prices: np.ndarray
+    total_nutrients: dict[str, float]
+    total_energy: float
+    total_price: float
+    target: Target
+    sensitivity: "Sensitivity | None"
+
+    # values[i, j] is the amount of the j-th key of target per unit_amount of
+    # the i-th product in the recipe, e.g. from NutrientMatrix.columns
+    def __init__(self, recipe: list[tuple[ProductRecord, float]], target: Target, values: np.ndarray):
+        self.recipe = recipe
+        self.target = target
+        self.keys = list(target.keys())
+        self.sensitivity = None
+
+        # how many of its unit_amounts of each product are used
+        scale = np.array([ units / prod.unit_amount for prod, units in recipe ], dtype=float)
+        values = np.asarray(values, dtype=float).reshape(len(recipe), len(self.keys))
+
+        self.contributions = values * scale[:, None]
+        self.total_nutrients = dict(zip(self.keys, (scale @ values).tolist()))
+        self.set_prices(scale)
+
+    def set_prices(self, scale: np.ndarray):
+        self.item_prices = scale * np.array([ prod.unit_price for prod, _ in self.recipe ], dtype=float)
+        self.total_price = float(self.item_prices.sum())
+
+        self.total_energy = self.total_nutrients["protein"] * 4.084\
+            + self.total_nutrients["carbohydrate"] * 4.184\
+            + self.total_nutrients["fat"] * 9.396
+
+    # everything needed to rebuild the solution without a database. it's all
+    # plain lists, dicts and numbers, so can go straight to json
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "recipe": [
+                {
+                    "product": prod.to_dict(),
+                    "units": float(units),
+                }
+                for prod, units in self.recipe
+            ],
+            "contributions": dict(zip(self.keys, self.contributions.T.tolist())),
+            "total_nutrients": self.total_nutrients,
+            "total_price": self.total_price,
+            "total_energy": self.total_energy,
+            "target": self.target,
+            "sensitivity": self.sensitivity.to_dict() if self.sensitivity else None,
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict[str, Any]) -> "Solution":
+        solution = cls.__new__(cls)
+
+        solution.recipe = [ (ProductRecord(**item["product"]), item["units"]) for item in d["recipe"] ]
+        solution.target = { k: tuple(v) for k, v in d["target"].items() }
+        solution.keys = list(solution.target.keys())
+        solution.contributions = np.array(
+            [ d["contributions"][k] for k in solution.keys ], dtype=float,
+        ).T.reshape(len(solution.recipe), len(solution.keys))
+        solution.total_nutrients = d["total_nutrients"]
+        solution.sensitivity = Sensitivity.from_dict(d["sensitivity"]) if d.get("sensitivity") else None
+
+        solution.set_prices(np.array([ units / prod.unit_amount for prod, units in solution.recipe ], dtype=float))
+
+        return solution
+
+    # the index in the recipe of the item giving the most of each key
+    def top_contributors(self) -> np.ndarray:
+        if len(self.recipe) == 0:
+            return np.zeros(len(self.keys), dtype=int)
+
+        return self.contributions.argmax(axis=0)
+
+    def print_nutrition(self):
+        if len(self.recipe) == 0:
+            return
+
+        top = self.top_contributors()
+
+        for j, k in enumerate(self.keys):
+            if k == "energy":
+                # this gets printed at the end, anyway
+                continue
+
+            disp = show_g(self.total_nutrients[k])
+
+            best = self.recipe[top[j]]
+            best_val = show_g(self.contributions[top[j], j])
+
+            print(f" {disp:>8}  {k:<16}  ** {best_val} from {best[1]:.2f} {best[0].unit_measure} x {best[0].name}")
+
+    def print_prices(self):
+        for i in sorted(range(len(self.recipe)), key=lambda i: self.recipe[i][1]):
+            prod, units = self.recipe[i]
+            print(f"   £{self.item_prices[i]:>5.2f}  {units:.2f} {prod.unit_measure} x {prod.name} ({prod.id})")
+
+    def print(self):
+        self.print_nutrition()
+        print()
+        self.print_prices()
+        print(f"  ------")
+        print(f"  energy:  {self.total_energy:.2f}kcal")
+        print(f"  total:   £{self.total_price:.2f}")
+
+Range = tuple[float | None, float | None]
+
+# how the price of a recipe responds to changes to the problem. it comes from
+# the LP where the recipe's products are the only ones usable, each anywhere
+# between its bounds, so it holds as long as the recipe keeps the same products.
+# everything is keyed like a Target, with a (min, max) pair per nutrient
+@dataclass
+class Sensitivity:
+    # the change in total price per unit each bound is raised
+    shadow_prices: dict[str, Range]
+    # how far each bound can move with the same shadow price
+    bound_ranges: dict[str, tuple[Range | None, Range | None]]
+    # how much cheaper, per unit_amount, each unused product would have to be
+    # before it would be worth using. only those closest are kept
+    reduced_costs: dict[str, float]
+    # the prices, per unit_amount, each used product could have without the
+    # recipe changing
+    price_ranges: dict[str, Range]
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "shadow_prices": self.shadow_prices,
+            "bound_ranges": self.bound_ranges,
+            "reduced_costs": self.reduced_costs,
+            "price_ranges": self.price_ranges,
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict[str, Any]) -> "Sensitivity":
+        def pair(p: list | None) -> Range | None:
+            return None if p is None else (p[0], p[1])
+
+        return cls(
+            shadow_prices={ k: (v[0], v[1]) for k, v in d["shadow_prices"].items() },
+            bound_ranges={ k: (pair(v[0]), pair(v[1])) for k, v in d["bound_ranges"].items() },
+            reduced_costs=d["reduced_costs"],
+            price_ranges={ k: (v[0], v[1]) for k, v in d["price_ranges"].items() },
+        )
+
+    # what each binding bound costs, as the change in price from raising it by
+    # 1%, and the range it can move in before that changes
+    def print(self, target: Target):
+        rows = []
+        for k, (mn, mx) in target.items():
+            for bound, value, price, range in [
+                ("min", mn, self.shadow_prices[k][0], self.bound_ranges[k][0]),
+                ("max", mx, self.shadow_prices[k][1], self.bound_ranges[k][1]),
+            ]:
+                if value is None or price is None or abs(price) < 1e-9:
+                    continue
+
+                lo, hi = range or (None, None)
+                span = f"{show_bound(k, lo) if lo is not None else '-inf'} .. {show_bound(k, hi) if hi is not None else 'inf'}"
+                rows.append((abs(price * value), f" {k + ' ' + bound:<20} {show_bound(k, value):>9}  +1% costs £{price * value / 100:+.4f}  (holds for {span})"))
+
+        print("what the binding bounds cost:")
+        for _, row in sorted(rows, reverse=True):
+            print(row)
+
+def show_bound(k: str, val: float) -> str:
+    return f"{val:.0f}kcal" if k == "energy" else show_g(val)
+
+def show_g(val: float) -> str:
+    if val < 1e-3:
+        disp = f"{val * 1e+6:.2f}µg"
+    elif val < 1:
+        disp = f"{val * 1e+3:.2f}mg"
+    elif val <= 500:
+        disp = f"{val:.2f}g"
+    else:
+        disp = f"{val / 1e+3:.2f}kg"
+
+    return disp
+
+# the maths of a Problem, without any products attached, so that it can be
+# handed to any backend or sent to another process. column i is the product
+# all_products[cols[i]], and can be either 0 or between lower[i] and upper[i]
+@dataclass
+class Model:
+    cols: np.ndarray
+    prices: np.ndarray
+    amounts: sparse.csr_matrix
+    goals: np.ndarray
+    lower: np.ndarray
+    upper: np.ndarray
+
+    # the size of the model, for instrumentation
+    def counts(self) -> dict[str, int]:
+        return { "cols": len(self.cols), "rows": len(self.goals), "nonzeros": int(self.amounts.nnz) }
+
+    def highs_lp(self) -> highspy.HighsLp:
+        amounts = self.amounts.tocsc()
+
+        lp = highspy.HighsLp()
+        lp.num_row_, lp.num_col_ = amounts.shape
+        lp.col_cost_ = self.prices
+        lp.col_lower_ = self.lower
+        lp.col_upper_ = self.upper
+        lp.row_lower_ = np.full(len(self.goals), -highspy.kHighsInf)
+        lp.row_upper_ = self.goals
+        lp.a_matrix_.format_ = highspy.MatrixFormat.kColwise
+        lp.a_matrix_.start_ = amounts.indptr
+        lp.a_matrix_.index_ = amounts.indices
+        lp.a_matrix_.value_ = amounts.data
+        lp.integrality_ = [ highspy.HighsVarType.kSemiContinuous ] * lp.num_col_
+
+        return lp
+
+# each backend solves a Model, returning the units of each column and whether
+# they're proven optimal, or None if it found no solution at all
+
+# called with each improving solution a backend finds, as the units of each
+# column, along with the relative gap to the best bound so far
+Incumbent = Callable[[np.ndarray, float], None]
+
+def solve_highs(
+    model: Model,
+    threads: int = 1,
+    time_limit: float | None = None,
+    gap: float | None = None,
+    on_incumbent: Incumbent | None = None,
+    **options,
+) -> tuple[np.ndarray, bool] | None:
+    highs = highspy.Highs()
+    highs.setOptionValue("output_flag", False)
+    highs.setOptionValue("threads", threads)
+    if time_limit is not None:
+        highs.setOptionValue("time_limit", time_limit)
+    if gap is not None:
+        highs.setOptionValue("mip_rel_gap", gap)
+    for k, v in options.items():
+        highs.setOptionValue(k, v)
+
+    if on_incumbent is not None:
+        # HiGHS adds a binary per semi-continuous column, after the model's own
+        n = len(model.cols)
+        highs.cbMipImprovingSolution.subscribe(
+            lambda e: on_incumbent(np.array(e.data_out.mip_solution[:n]), e.data_out.mip_gap)
+        )
+
+    with instruments.phase("solve", backend="highs", **model.counts()) as stats:
+        highs.passModel(model.highs_lp())
+        highs.run()
+
+        status = highs.getModelStatus()
+        info = highs.getInfo()
+        stats.update(
+            status=highs.modelStatusToString(status).lower(),
+            nodes=info.mip_node_count,
+            iterations=info.simplex_iteration_count,
+        )
+
+    if not highs.getSolution().value_valid:
+        return None
+
+    return np.array(highs.getSolution().col_value), status == highspy.HighsModelStatus.kOptimal
+
+# the Sensitivity of a recipe, given as the units xs of each of the model's
+# columns, whose products' ids are in ids. only the near reduced costs closest
+# to 0 are kept
+def sensitivity(
+    model: Model,
+    xs: np.ndarray,
+    target: Target,
+    ids: Sequence[str],
+    near: int = 50,
+) -> Sensitivity | None:
+    used = xs > 0
+    fixed = Model(
+        cols=model.cols,
+        prices=model.prices,
+        amounts=model.amounts,
+        goals=model.goals,
+        lower=np.where(used, model.lower, 0.0),
+        upper=np.where(used, model.upper, 0.0),
+    )
+
+    lp = fixed.highs_lp()
+    lp.integrality_ = []
+
+    highs = highspy.Highs()
+    highs.setOptionValue("output_flag", False)
+    highs.passModel(lp)
+    highs.run()
+
+    if highs.getModelStatus() != highspy.HighsModelStatus.kOptimal:
+        return None
+
+    solution = highs.getSolution()
+    row_duals = np.array(solution.row_dual)
+    col_duals = np.array(solution.col_dual)
+    _, ranging = highs.getRanging()
+
+    def finite(x: float) -> float | None:
+        return None if abs(x) >= highspy.kHighsInf else float(x)
+
+    # min rows are negated, so their duals and ranges are too
+    keys, signs, _ = target_rows(target)
+    shadow_prices: dict[str, list[float | None]] = { k: [None, None] for k in target }
+    bound_ranges: dict[str, list[Range | None]] = { k: [None, None] for k in target }
+
+    for i, (k, sign) in enumerate(zip(keys, signs)):
+        side = 0 if sign < 0 else 1
+        lo, hi = sorted((sign * ranging.row_bound_dn.value_[i], sign * ranging.row_bound_up.value_[i]))
+
+        shadow_prices[k][side] = float(sign * row_duals[i])
+        bound_ranges[k][side] = (finite(lo), finite(hi))
+
+    unused = np.flatnonzero(~used & (model.upper > 0))
+    closest = unused[np.argsort(np.abs(col_duals[unused]), kind="stable")[:near]]
+
+    return Sensitivity(
+        shadow_prices={ k: (mn, mx) for k, (mn, mx) in shadow_prices.items() },
+        bound_ranges={ k: (mn, mx) for k, (mn, mx) in bound_ranges.items() },
+        reduced_costs={ ids[model.cols[j]]: float(col_duals[j]) for j in closest },
+        price_ranges={
+            ids[model.cols[j]]: (
+                finite(ranging.col_cost_dn.value_[j]),
+                finite(ranging.col_cost_up.value_[j]),
+            )
+            for j in np.flatnonzero(used)
+        },
+    )
+
+# every product the solver might use, with its taxonomies, and their matrix
+# from the collated nutrition table
+def load_catalogue(session: Session) -> tuple[list[Product], NutrientMatrix]:
+    collated = get_collated(session)
+    products = get_products(
+        session,
+        load_taxonomies=True,
+        id_blacklist=global_id_blacklist,
+        only_proper_measures=True,
+    )
+
+    with instruments.phase("matrix", products=len(products), source="collated"):
+        matrix = NutrientMatrix.from_collated(products, collated)
+
+    return products, matrix
+
+@dataclass
+class Problem:
+    all_nutrient_amounts: sparse.csr_matrix
+    all_prices: np.ndarray
+    all_bounds: np.ndarray
+    all_products: ProductTable
+    matrix: NutrientMatrix
+    index: dict[str, int]
+
+    goals: list[float]
+    goals_map: dict[str, int]
+    goal_keys: list[tuple[str, float]] | None
+    exact_rows: list[int]
+
+    # which products the solver may use. kept up to date by ban/unban and the
+    # taxonomy (un)list methods; reapply_filter rebuilds it from scratch after
+    # the lists have been assigned directly. blacklisted and whitelisted are
+    # whether each product is under any taxon in the lists
+    allowed: np.ndarray
+    usable: np.ndarray
+    banned: np.ndarray
+    blacklisted: np.ndarray
+    whitelisted: np.ndarray
+
+    # the products presolve found to be dominated, last time it ran
+    dropped: np.ndarray
+
+    target: Target
+    banned_ids: list[str]
+    taxonomy_whitelist: list[int]
+    taxonomy_blacklist: list[int]
+
+    def __init__(self, target: Target, session: Session):
+        self.banned_ids = []
+        self.taxonomy_blacklist = []
+        self.taxonomy_whitelist = []
+
+        self.load_products(session)
+        assert self.all_products is not None
+
+        self.set_target(target)
+
+    # a problem over the products in a catalogue snapshot (see src/snapshot.py),
+    # which needs no database at all
+    @classmethod
+    def from_snapshot(cls, target: Target, snapshot: Snapshot) -> "Problem":
+        problem = cls.__new__(cls)
+
+        problem.banned_ids = []
+        problem.taxonomy_blacklist = []
+        problem.taxonomy_whitelist = []
+
+        problem.set_catalogue(snapshot.products(), snapshot.matrix())
+        problem.set_target(target)
+
+        return problem
+
+    # a problem over the whole catalogue, from the snapshot at path (by
+    # default, the engine's database's snapshot_path) if it's up to date with
+    # the database, or else from the database (and the snapshot is then
+    # rewritten, for next time). a database not in a file is always read
+    @classmethod
+    def load(cls, target: Target, engine: Engine, path: str | None = None) -> "Problem":
+        database = engine.url.database
+
+        if not database or database == ":memory:":
+            with instruments.phase("load", source="database") as stats, Session(engine) as session:
+                problem = cls(target, session)
+                stats["products"] = len(problem.all_products)
+
+            return problem
+
+        version = catalogue_version(database)
+        path = path or snapshot_path(database)
+
+        with instruments.phase("load", source="snapshot") as stats:
+            if not os.path.exists(path) or not Snapshot.open(path).is_current(version, global_id_blacklist):
+                stats["source"] = "database"
+
+                with Session(engine) as session:
+                    Snapshot.write(path, *load_catalogue(session), version, global_id_blacklist)
+
+            problem = cls.from_snapshot(target, Snapshot.open(path))
+            stats["products"] = len(problem.all_products)
+
+        return problem
+
+    # a problem over products which have already been loaded, with their
+    # taxonomies and nutritions
+    @classmethod
+    def from_products(cls, target: Target, products: list[Product]) -> "Problem":
+        problem = cls.__new__(cls)
+
+        problem.banned_ids = []
+        problem.taxonomy_blacklist = []
+        problem.taxonomy_whitelist = []
+
+        problem.set_products(products)
+        problem.set_target(target)
+
+        return problem
+
+    def set_target(self, target: Target):
+        for req in required_nutrients:
+            if req not in target:
+                target[req] = (0, None)
+
+        keys, signs, goals = target_rows(target)
+
+        # if only the bounds changed, the rows are the same as before. the
+        # rows are built before anything is changed, so an unknown key
+        # leaves the problem as it was
+        goal_keys = list(zip(keys, signs))
+        if getattr(self, "goal_keys", None) != goal_keys:
+            self.all_nutrient_amounts = self.matrix.sparse_rows(keys, signs)
+            self.goal_keys = goal_keys
+
+        self.target = target
+        self.goals = goals
+        self.goals_map = { k: i for i, k in enumerate(keys) }
+
+        # rows of nutrients with both a minimum and a maximum
+        self.exact_rows = [ i for i, k in enumerate(keys) if keys.count(k) == 2 ]
+
+        self.reapply_filter()
+
+    def load_products(self, session: Session):
+        products, matrix = load_catalogue(session)
+        self.set_catalogue(ProductTable.from_products(products), matrix)
+
+    # only the matrix and the scalar columns of the products are kept, so the
+    # ORM objects can be let go of
+    def set_products(self, products: list[Product]):
+        with instruments.phase("matrix", products=len(products)):
+            matrix = NutrientMatrix(products)
+
+        self.set_catalogue(ProductTable.from_products(products), matrix)
+
+    def set_catalogue(self, products: ProductTable, matrix: NutrientMatrix):
+        self.all_products = products
+
+        self.matrix = matrix
+        self.index = products.index
+        self.all_prices = np.asarray(products.columns["unit_price"], dtype=float)
+
+        # (min, max) units of each product set by set_bounds. nan where unset
+        self.all_bounds = np.full((len(products), 2), np.nan)
+
+        # the units of each product to use, if it's used at all
+        measures = products.columns["unit_measure"]
+        self.min_units = np.array([ min_to_use[m] for m in measures ], dtype=float) / self.matrix.unit_amounts
+        self.max_units = np.array([ max_to_use[m] for m in measures ], dtype=float) / self.matrix.unit_amounts
+
+        # products need a carbohydrate source at the very least
+        self.usable = self.matrix.known("carbohydrate")
+        self.dropped = np.zeros(len(self.all_products), dtype=bool)
+
+        # any rows and filters were built over the old catalogue
+        self.goal_keys = None
+        if getattr(self, "target", None) is not None:
+            self.set_target(self.target)
+
+    @property
+    def products(self) -> list[ProductRecord]:
+        return [ self.all_products[i] for i in np.flatnonzero(self.allowed) ]
+
+    def product_allowed(self, product: Product | ProductRecord) -> bool:
+        return bool(self.allowed[self.index[product.id]])
+
+    def set_bounds(self, product_id: str, min: float | None, max: float | None = None):
+        idx = self.index[product_id]
+        if not self.allowed[idx]:
+            print("bounds set for disallowed product:", self.all_products.columns["name"][idx])
+        self.all_bounds[idx] = (np.nan if min is None else min, np.nan if max is None else max)
+
+    def reapply_filter(self):
+        n = len(self.all_products)
+
+        with instruments.phase("filter") as stats:
+            self.banned = np.zeros(n, dtype=bool)
+            self.banned[[ self.index[id] for id in self.banned_ids if id in self.index ]] = True
+
+            self.allowed = np.zeros(n, dtype=bool)
+            self.refresh_taxa()
+
+            stats.update(products=n, allowed=int(self.allowed.sum()))
+
+    # recomputes which products are under the listed taxa, which is a couple
+    # of ANDs over the taxonomy bitsets, and so whether each is allowed
+    def refresh_taxa(self):
+        self.blacklisted = self.matrix.in_any(self.taxonomy_blacklist)
+        self.whitelisted = self.matrix.in_any(self.taxonomy_whitelist)
+        self.refresh_allowed(slice(None))
+
+    # recomputes whether the products at idx are allowed
+    def refresh_allowed(self, idx: np.ndarray | slice):
+        self.allowed[idx] = self.usable[idx] & ~self.banned[idx] & ~(
+            self.blacklisted[idx] & ~self.whitelisted[idx]
+        )
+
+    def ban(self, product_id: str):
+        if product_id not in self.banned_ids:
+            self.banned_ids.append(product_id)
+        self.set_banned(product_id, True)
+
+    def unban(self, product_id: str):
+        if product_id in self.banned_ids:
+            self.banned_ids.remove(product_id)
+        self.set_banned(product_id, False)
+
+    def set_banned(self, product_id: str, banned: bool):
+        if (i := self.index.get(product_id)) is None:
+            return
+
+        self.banned[i] = banned
+        self.refresh_allowed(slice(i, i + 1))
+
+    def blacklist_taxon(self, taxon: int):
+        if taxon not in self.taxonomy_blacklist:
+            self.taxonomy_blacklist.append(taxon)
+            self.refresh_taxa()
+
+    def unblacklist_taxon(self, taxon: int):
+        if taxon in self.taxonomy_blacklist:
+            self.taxonomy_blacklist.remove(taxon)
+            self.refresh_taxa()
+
+    def whitelist_taxon(self, taxon: int):
+        if taxon not in self.taxonomy_whitelist:
+            self.taxonomy_whitelist.append(taxon)
+            self.refresh_taxa()
+
+    def unwhitelist_taxon(self, taxon: int):
+        if taxon in self.taxonomy_whitelist:
+            self.taxonomy_whitelist.remove(taxon)
+            self.refresh_taxa()
+
+    # the semi-continuous bounds on the units of every product: either 0, or
+    # between the two. disallowed products are fixed at 0, so the solver can
+    # be handed the whole matrix rather than a filtered copy of it
+    # with presolve, dominated products (see src/presolve.py) are fixed at
+    # 0 too, and marked in self.dropped
+    def column_bounds(self, presolve: bool = False) -> tuple[np.ndarray, np.ndarray]:
+        lower = np.fmax(self.all_bounds[:, 0], self.min_units)
+        upper = np.fmin(self.all_bounds[:, 1], self.max_units)
+
+        lower[~self.allowed] = 0.0
+        upper[~self.allowed] = 0.0
+
+        if presolve:
+            self.dropped = dominated_columns(
+                self.all_nutrient_amounts,
+                np.array(self.goals, dtype=float),
+                self.all_prices,
+                lower,
+                upper,
+                self.matrix.unit_amounts,
+                exact_rows=self.exact_rows,
+            )
+
+            lower[self.dropped] = 0.0
+            upper[self.dropped] = 0.0
+
+        return lower, upper
+
+    # the cheapest recipe, or the best found within time_limit seconds or gap
+    # (relative) of optimal, if given. on_incumbent is called with each better
+    # recipe as it's found
+    def solve(
+        self,
+        time_limit: float | None = None,
+        gap: float | None = None,
+        on_incumbent: Callable[[Solution], None] | None = None,
+    ) -> Solution | None:
+        if not self.allowed.any():
+            return None
+
+        model = self.model()
+        incumbent = None
+        if on_incumbent is not None:
+            incumbent = lambda x, _: on_incumbent(self.make_model_recipe(model, x, with_sensitivity=False))
+
+        result = solve_highs(model, time_limit=time_limit, gap=gap, on_incumbent=incumbent)
+        if result is None:
+            return None
+
+        return self.make_model_recipe(model, result[0])
+
+    # solves in the background, yielding each better recipe as it's found, and
+    # then the final one (with its sensitivity) along with True
+    def solve_anytime(
+        self,
+        time_limit: float | None = None,
+        gap: float | None = None,
+    ) -> Iterator[tuple[Solution, bool]]:
+        if not self.allowed.any():
+            return
+
+        model = self.model()
+        found: queue.Queue = queue.Queue()
+
+        def run():
+            try:
+                incumbent = lambda x, _: found.put(("incumbent", x))
+                found.put(("done", solve_highs(model, time_limit=time_limit, gap=gap, on_incumbent=incumbent)))
+            except Exception as e:
+                found.put(("error", e))
+
+        threading.Thread(target=run, daemon=True).start()
+
+        while True:
+            kind, value = found.get()
+
+            if kind == "incumbent":
+                yield self.make_model_recipe(model, value, with_sensitivity=False), False
+            elif kind == "error":
+                raise value
+            else:
+                if value is not None:
+                    yield self.make_model_recipe(model, value[0]), True
+                return
+
+    # the model of this problem. unless all is set, only the allowed products
+    # (which survive presolve) get a column, or only those of them in within
+    def model(self, all: bool = False, presolve: bool = True, within: np.ndarray | None = None) -> Model:
+        with instruments.phase("model") as stats:
+            lower, upper = self.column_bounds(presolve)
+            amounts = self.all_nutrient_amounts
+
+            if all:
+                cols = np.arange(len(self.all_products))
+            else:
+                cols = np.flatnonzero(upper > 0)
+                if within is not None:
+                    cols = np.intersect1d(cols, within)
+                amounts = amounts[:, cols]
+
+            model = Model(
+                cols=cols,
+                prices=self.all_prices[cols],
+                amounts=amounts,
+                goals=np.array(self.goals, dtype=float),
+                lower=lower[cols],
+                upper=upper[cols],
+            )
+
+            stats.update(model.counts(), dropped=int(self.dropped.sum()) if presolve else 0)
+
+        return model
+
+    # xs are the units of each of the model's columns. unless told not to, the
+    # solution also gets the sensitivity of the recipe to the model
+    def make_model_recipe(
+        self,
+        model: Model,
+        xs: np.ndarray,
+        target: Target | None = None,
+        with_sensitivity: bool = True,
+    ) -> Solution:
+        all_xs = np.zeros(len(self.all_products))
+        all_xs[model.cols] = xs
+
+        with instruments.phase("solution") as stats:
+            solution = self.make_recipe(all_xs, target)
+            stats["items"] = len(solution.recipe)
+
+        if with_sensitivity and len(solution.recipe) > 0:
+            with instruments.phase("sensitivity"):
+                solution.sensitivity = sensitivity(model, xs, solution.target, self.all_products.ids)
+
+        return solution
+
+    def cache_key(self, version: str, method: str = "highs") -> str:
+        bounds = {
+            self.all_products.ids[i]: tuple(self.all_bounds[i])
+            for i in np.flatnonzero(~np.isnan(self.all_bounds).all(axis=1))
+        }
+
+        return solve_key(
+            self.target,
+            self.banned_ids,
+            self.taxonomy_whitelist,
+            self.taxonomy_blacklist,
+            bounds,
+            version,
+            method,
+        )
+
+    # xs are the units of each of all_products. the solution is reported
+    # against the problem's target, unless another is given
+    def make_recipe(self, xs: np.ndarray, target: Target | None = None) -> Solution:
+        target = target or self.target
+        used = np.flatnonzero(xs > 0)
+
+        recipe = []
+        for i in used:
+            prod = self.all_products[i]
+            recipe.append((prod, float(xs[i] * prod.unit_amount)))
+
+        return Solution(recipe, target, self.matrix.columns(list(target.keys()), used))
+
+# a canonical hash of everything which decides the answer to a problem, so
+# that identical problems can be answered from a SolveCache. version should be
+# the catalogue_version of the database the products come from
+def solve_key(
+    target: Target,
+    banned_ids: list[str],
+    taxonomy_whitelist: list[int],
+    taxonomy_blacklist: list[int],
+    bounds: dict[str, tuple[float | None, float | None]],
+    version: str,
+    method: str = "highs",
+) -> str:
+    def num(x: float | None) -> float | None:
+        return None if x is None or np.isnan(x) else float(x)
+
+    full_target = { req: (0, None) for req in required_nutrients } | target
+
+    canonical = json.dumps({
+        "target": sorted((k, num(mn), num(mx)) for k, (mn, mx) in full_target.items()),
+        "banned_ids": sorted(set(banned_ids) | set(global_id_blacklist)),
+        "taxonomy_whitelist": sorted(set(taxonomy_whitelist)),
+        "taxonomy_blacklist": sorted(set(taxonomy_blacklist)),
+        "bounds": sorted((id, num(mn), num(mx)) for id, (mn, mx) in bounds.items()),
+        "min_to_use": sorted(min_to_use.items()),
+        "max_to_use": sorted(max_to_use.items()),
+        "version": version,
+        "method": method,
+    }, separators=(",", ":"))
+
+    return hashlib.sha256(canonical.encode()).hexdigest()
@@ -0,0 +1,95 @@
+import numpy as np
+from typing import Any, Sequence
+from src.data import Product, ProductBase
+
+# the scalar columns of a Product, and how each is stored: "text", "number"
+# or "flag"
+def product_fields() -> dict[str, str]:
+    kinds = { float: "number", bool: "flag" }
+    fields = { "id": "text" }
+
+    for name, info in ProductBase.model_fields.items():
+        fields[name] = kinds.get(info.annotation, "text") # type: ignore
+
+    return fields
+
+# a product as the solver sees it: just its scalar columns, without any of the
+# ORM's bookkeeping, taxonomies or nutritions (which are in the NutrientMatrix)
+class ProductRecord:
+    __slots__ = (
+        "id", "name", "description", "image_url", "url", "unit_price",
+        "unit_measure", "unit_amount", "retail_price", "is_alcohol", "brand",
+    )
+
+    id: str
+    name: str
+    description: str
+    image_url: str | None
+    url: str
+    unit_price: float
+    unit_measure: str
+    unit_amount: float
+    retail_price: float
+    is_alcohol: bool
+    brand: str | None
+
+    def __init__(self, **fields: Any):
+        for k in self.__slots__:
+            setattr(self, k, fields.get(k))
+
+        if self.is_alcohol is None:
+            self.is_alcohol = False
+
+    @classmethod
+    def from_product(cls, product: Product) -> "ProductRecord":
+        return cls(**{ k: getattr(product, k) for k in cls.__slots__ })
+
+    def to_dict(self) -> dict[str, Any]:
+        return { k: getattr(self, k) for k in self.__slots__ }
+
+    def __repr__(self) -> str:
+        return f"ProductRecord(id={self.id!r}, name={self.name!r})"
+
+# the products of a catalogue, stored by column. rows are looked up by
+# position, or by id through index, and each is only made into a
+# ProductRecord when it's asked for
+class ProductTable(Sequence[ProductRecord]):
+    columns: dict[str, Sequence[Any]]
+    index: dict[str, int]
+
+    def __init__(self, columns: dict[str, Sequence[Any]]):
+        self.columns = columns
+        self.index = { id: i for i, id in enumerate(columns["id"]) }
+
+    @classmethod
+    def from_products(cls, products: list[Product]) -> "ProductTable":
+        columns: dict[str, Sequence[Any]] = {}
+
+        for field, kind in product_fields().items():
+            column = [ getattr(p, field) for p in products ]
+
+            if kind == "text":
+                columns[field] = column
+            else:
+                columns[field] = np.array(column, dtype=float if kind == "number" else bool)
+
+        return cls(columns)
+
+    @property
+    def ids(self) -> Sequence[str]:
+        return self.columns["id"]
+
+    def __len__(self) -> int:
+        return len(self.columns["id"])
+
+    def __getitem__(self, i): # type: ignore
+        if isinstance(i, slice):
+            return [ self[j] for j in range(*i.indices(len(self))) ]
+
+        return ProductRecord(**{ k: scalar(col[i]) for k, col in self.columns.items() })
+
+    def get(self, id: str) -> ProductRecord | None:
+        return self[i] if (i := self.index.get(id)) is not None else None
+
+def scalar(value: Any) -> Any:
+    return value.item() if isinstance(value, np.generic) else value
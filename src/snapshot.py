@@ -0,0 +1,171 @@
+import os
+import struct
+import zipfile
+import numpy as np
+from dataclasses import dataclass
+from typing import Mapping, Sequence
+from src.data import Product
+from src.matrix import NUTRIENTS, NutrientMatrix
+from src.products import ProductTable, product_fields
+
+# bumped whenever the layout below changes, so old snapshots are rebuilt
+SNAPSHOT_FORMAT = 2
+
+# a snapshot of everything the solver needs from the catalogue, so a Problem
+# can be set up without the ORM. it's an uncompressed .npz of:
+#
+#  - the scalar columns of every Product: numbers and flags as plain arrays,
+#    and text as utf-8 bytes ("<field>.data") sliced by "<field>.offsets",
+#    with "<field>.null" marking Nones
+#  - the collated NutrientMatrix (values, sureness and unit_amounts)
+#  - taxonomy membership, as the matrix's bitset per product ("taxon_bits",
+#    where bit b is for taxon "taxa"[b])
+#
+# along with the format, the catalogue_version of the database it came from
+# and the ids which were left out, to tell when it's out of date
+@dataclass
+class Snapshot:
+    arrays: Mapping[str, np.ndarray]
+
+    @classmethod
+    def open(cls, path: str) -> "Snapshot":
+        return cls(load_npz(path))
+
+    @staticmethod
+    def write(path: str, products: list[Product], matrix: NutrientMatrix, version: str, id_blacklist: list[str] = []):
+        arrays: dict[str, np.ndarray] = {
+            "format": np.array(SNAPSHOT_FORMAT),
+            "catalogue_version": np.array(version),
+            "id_blacklist": np.array(sorted(id_blacklist), dtype=str),
+            "nutrients": np.array(NUTRIENTS, dtype=str),
+            "values": matrix.values,
+            "sureness": matrix.sureness,
+            "unit_amounts": matrix.unit_amounts,
+        }
+
+        for field, kind in product_fields().items():
+            column = [ getattr(p, field) for p in products ]
+
+            if kind == "text":
+                encoded = [ (v or "").encode() for v in column ]
+                arrays[f"{field}.data"] = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+                arrays[f"{field}.offsets"] = np.cumsum([0] + [ len(b) for b in encoded ], dtype=np.int64)
+                arrays[f"{field}.null"] = np.array([ v is None for v in column ], dtype=bool)
+            else:
+                arrays[field] = np.array(column, dtype=float if kind == "number" else bool)
+
+        arrays["taxa"] = matrix.taxa
+        arrays["taxon_bits"] = matrix.taxon_bits
+
+        # written beside the old one and then swapped in, so a snapshot being
+        # read is never half-written
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, path)
+
+    def __len__(self) -> int:
+        return len(self.arrays["unit_amounts"])
+
+    # whether this was made, in the current format, from the database at
+    # the given catalogue_version, leaving out the given ids
+    def is_current(self, version: str, id_blacklist: list[str] = []) -> bool:
+        return int(self.arrays["format"]) == SNAPSHOT_FORMAT\
+            and str(self.arrays["catalogue_version"]) == version\
+            and self.arrays["id_blacklist"].tolist() == sorted(id_blacklist)\
+            and self.arrays["nutrients"].tolist() == NUTRIENTS
+
+    def matrix(self) -> NutrientMatrix:
+        return NutrientMatrix.from_arrays(
+            self.arrays["values"],
+            self.arrays["sureness"],
+            self.arrays["unit_amounts"],
+            self.arrays["taxa"],
+            self.arrays["taxon_bits"],
+        )
+
+    def texts(self, field: str) -> list[str | None]:
+        data = self.arrays[f"{field}.data"].tobytes()
+        offsets = self.arrays[f"{field}.offsets"].tolist()
+        null = self.arrays[f"{field}.null"].tolist()
+
+        return [
+            None if null[i] else data[offsets[i]:offsets[i + 1]].decode()
+            for i in range(len(null))
+        ]
+
+    def text(self, field: str, i: int) -> str | None:
+        if self.arrays[f"{field}.null"][i]:
+            return None
+
+        start, end = self.arrays[f"{field}.offsets"][i:i + 2]
+        return self.arrays[f"{field}.data"][start:end].tobytes().decode()
+
+    # the products, with the ids and measures (which the solver needs for
+    # every product) decoded up front, and the other text only when it's read
+    def products(self) -> ProductTable:
+        columns: dict[str, Sequence] = {}
+
+        for field, kind in product_fields().items():
+            if kind != "text":
+                columns[field] = self.arrays[field]
+            elif field in ["id", "unit_measure"]:
+                columns[field] = self.texts(field)
+            else:
+                columns[field] = TextColumn(self, field)
+
+        return ProductTable(columns)
+
+# one text column of a snapshot, decoded a row at a time
+class TextColumn(Sequence[str | None]):
+    def __init__(self, snapshot: Snapshot, field: str):
+        self.snapshot = snapshot
+        self.field = field
+
+    def __len__(self) -> int:
+        return len(self.snapshot)
+
+    def __getitem__(self, i): # type: ignore
+        if isinstance(i, slice):
+            return [ self[j] for j in range(*i.indices(len(self))) ]
+
+        i = int(i) + (len(self) if i < 0 else 0)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+
+        return self.snapshot.text(self.field, i)
+
+# the arrays of an uncompressed .npz, memory-mapped. np.load can't map the
+# members of an archive, but each one is a whole .npy file stored as-is, so
+# its data can be mapped from just after its header
+def load_npz(path: str) -> dict[str, np.ndarray]:
+    arrays = {}
+
+    with zipfile.ZipFile(path) as archive, open(path, "rb") as f:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{path} is compressed, so can't be mapped")
+
+            # a local file header is 30 bytes, then the name and extra field,
+            # whose lengths are its last four
+            f.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack("<HH", f.read(4))
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+
+            name = info.filename.removesuffix(".npy")
+            if dtype.hasobject or np.prod(shape) == 0:
+                f.seek(info.header_offset + 30 + name_length + extra_length)
+                arrays[name] = np.lib.format.read_array(f)
+            else:
+                arrays[name] = np.memmap(
+                    path, dtype=dtype, mode="r", offset=f.tell(),
+                    shape=shape, order="F" if fortran else "C",
+                )
+
+    return arrays
@@ -0,0 +1,137 @@
+import json
+import threading
+from dataclasses import dataclass, field
+from typing import Any
+from sqlalchemy import distinct, func
+from sqlmodel import Session, select
+from src.cache import catalogue_version
+from src.data import ProductTaxonomy, Taxonomy, TaxonomyClosure, ensure_taxonomy_closure, linked_descendants
+from src.metrics import instruments
+
+# what each node of a taxonomy response can have. without depth or fields,
+# responses have just the first five, with every level of children
+TAXON_FIELDS = ["name", "id", "parent_id", "parent_name", "children", "child_count", "product_count"]
+
+# the whole taxonomy, loaded with one query and kept as plain dicts, so any
+# subtree (or the taxa containing a product) is put together in memory rather
+# than lazy-loading each node's children and parent
+@dataclass
+class TaxonomyTree:
+    names: dict[int, str]
+    parents: dict[int, int | None]
+    children: dict[int, list[int]]
+
+    @classmethod
+    def load(cls, session: Session) -> "TaxonomyTree":
+        names, parents = {}, {}
+        children: dict[int, list[int]] = {}
+
+        for id, name, parent_id in session.exec(select(Taxonomy.id, Taxonomy.name, Taxonomy.parent_id).order_by(Taxonomy.id)):
+            names[id] = name
+            parents[id] = parent_id
+            if parent_id is not None:
+                children.setdefault(parent_id, []).append(id)
+
+        return cls(names, parents, children)
+
+    def __contains__(self, id: int) -> bool:
+        return id in self.names
+
+    # the subtree at id, laid out as a TaxonomyResponse. with filter_ids, only
+    # the taxa in it are kept, along with only those of their children which
+    # are kept too. with depth, only that many levels below id are included,
+    # and child_count says which of the last have more to expand. fields
+    # picks which of TAXON_FIELDS each node has; product_count needs
+    # product_counts, as from TaxonomyCache.product_counts
+    def response(
+        self,
+        id: int,
+        filter_ids: set[int] | None = None,
+        depth: int | None = None,
+        fields: list[str] = TAXON_FIELDS[:5],
+        product_counts: dict[int, int] = {},
+    ) -> dict[str, Any] | None:
+        if id not in self.names or (filter_ids is not None and id not in filter_ids):
+            return None
+
+        node: dict[str, Any] = {}
+        for f in fields:
+            match f:
+                case "name":
+                    node[f] = self.names[id]
+                case "id":
+                    node[f] = id
+                case "parent_id":
+                    node[f] = self.parents[id]
+                case "parent_name":
+                    node[f] = self.names.get(self.parents[id]) # type: ignore
+                case "children":
+                    node[f] = [
+                        response for child in self.children.get(id, [])
+                        if depth is None or depth > 0
+                        if (response := self.response(
+                            child, filter_ids, None if depth is None else depth - 1, fields, product_counts,
+                        )) is not None
+                    ]
+                case "child_count":
+                    node[f] = len(self.children.get(id, []))
+                case "product_count":
+                    node[f] = product_counts.get(id, 0)
+
+        return node
+
+    def serialise(self, id: int, filter_ids: set[int] | None = None, **options: Any) -> bytes:
+        return json.dumps(self.response(id, filter_ids, **options), separators=(",", ":")).encode()
+
+# the taxonomy tree, and the whole of it already serialised, kept until the
+# database changes (as when collate rebuilds the taxonomy)
+@dataclass
+class TaxonomyCache:
+    version: str | None = None
+    tree: TaxonomyTree | None = None
+    serialised: bytes = b"null"
+    counts: dict[int, int] | None = None
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def get(self, session: Session) -> TaxonomyTree:
+        version = catalogue_version()
+
+        with self.lock:
+            if self.tree is None or version != self.version:
+                instruments.emit("cache", cache="taxonomy", hit=False)
+
+                self.tree = TaxonomyTree.load(session)
+                self.serialised = self.tree.serialise(0)
+                self.counts = None
+                self.version = version
+            else:
+                instruments.emit("cache", cache="taxonomy", hit=True)
+
+            return self.tree
+
+    # the whole tree, from the root, as json
+    def whole(self, session: Session) -> bytes:
+        self.get(session)
+        return self.serialised
+
+    # the number of products under each taxon, from one query over the
+    # closure table, made the first time they're asked for
+    def product_counts(self, session: Session) -> dict[int, int]:
+        # filling in the closure writes to the database, which would make the
+        # tree (and the counts with it) out of date as soon as they're made
+        ensure_taxonomy_closure(session)
+        self.get(session)
+
+        with self.lock:
+            if self.counts is None:
+                self.counts = dict(session.exec(
+                    select(TaxonomyClosure.ancestor_id, func.count(distinct(ProductTaxonomy.product_id)))
+                    .join(ProductTaxonomy, linked_descendants())
+                    .group_by(TaxonomyClosure.ancestor_id)
+                ).all())
+
+            return self.counts
+
+    def clear(self):
+        with self.lock:
+            self.tree, self.version = None, None